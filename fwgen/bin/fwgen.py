@@ -1,17 +1,19 @@
 import argparse
 import signal
 import sys
-import json
+import os
 import logging
-import traceback
-from collections import OrderedDict
-from pathlib import Path
 
-from fwgen import fwgen, __version__
-from fwgen.helpers import yaml_load_ordered, ordered_dict_merge
+from fwgen import __version__
+
+# The subcommands import fwgen.fwgen and other modules only when needed, to
+# keep the startup time low for frequent invocations like 'show running'
 
 
 LOGGER = logging.getLogger()
+CONFIG_CACHE_DIR = '/var/lib/fwgen/config-cache'
+DEFAULTS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'etc', 'defaults.yml')
 
 
 class TimeoutExpired(Exception):
@@ -31,7 +33,7 @@ def wait_for_input(message, timeout):
         # Cancel alarm
         signal.alarm(0)
 
-def merge_config(defaults_file, config_file, config_json=None):
+def merge_config(defaults_file, config_file, config_json=None, cache_dir=None):
     """
     Configuration merge order. Each merge overrides the previous one if a parameter
     is provided in both configurations.
@@ -39,16 +41,21 @@ def merge_config(defaults_file, config_file, config_json=None):
         1. config from defaults file
         2. config from config file
         3. config provided at runtime via --config-json
+
+    The layers are not merged up front, but returned as a LayeredDict view that
+    resolves each value on access. The parsed YAML files are cached in
+    cache_dir if given.
     """
+    import json
+    from collections import OrderedDict
+    from fwgen.helpers import yaml_load_file, LayeredDict
+
     LOGGER.debug("Loading defaults file '%s'", defaults_file)
-    with open(defaults_file, 'r') as f:
-        config = yaml_load_ordered(f) or {}
+    layers = [yaml_load_file(defaults_file, cache_dir) or {}]
 
     LOGGER.debug("Loading config file '%s'", config_file)
     try:
-        with open(config_file, 'r') as f:
-            user_config = yaml_load_ordered(f) or {}
-        config = ordered_dict_merge(user_config, config)
+        layers.append(yaml_load_file(config_file, cache_dir) or {})
     except FileNotFoundError:
         if config_json is None:
             raise
@@ -56,12 +63,12 @@ def merge_config(defaults_file, config_file, config_json=None):
                        "be fed via '--config-json'", config_file)
 
     if config_json is not None:
-        json_config = json.loads(config_json, object_pairs_hook=OrderedDict)
-        config = ordered_dict_merge(json_config, config)
+        layers.append(json.loads(config_json, object_pairs_hook=OrderedDict))
 
-    return config
+    return LayeredDict(*layers)
 
 def archive_subcommands(args, config):
+    from fwgen import fwgen
     fw = fwgen.FwGen(config)
 
     if args.diff:
@@ -77,10 +84,13 @@ def archive_subcommands(args, config):
     return 0
 
 def config_subcommands(args, config):
-    print(json.dumps(config, indent=4))
+    import json
+    from fwgen.helpers import json_default
+    print(json.dumps(config, indent=4, default=json_default))
     return 0
 
 def running_subcommands(args, config):
+    from fwgen import fwgen
     fw = fwgen.FwGen(config)
     selection = args.select
 
@@ -98,8 +108,33 @@ def running_subcommands(args, config):
         print('\n'.join(fw.running_ip6tables()))
     return 0
 
+def generated_subcommands(args, config):
+    from fwgen import fwgen
+    fw = fwgen.FwGen(config, cache=not args.no_cache, cache_salt=args.config_json)
+    iptables, ip6tables, ipsets = fw.generate()
+    selection = args.select
+
+    if not selection:
+        selection = 'all'
+
+    if selection in ['ipsets', 'all']:
+        print('#\n#\n# IPSETS\n#')
+        for rule in ipsets:
+            print(rule)
+    if selection in ['iptables', 'fw', 'fw4', 'all']:
+        print('#\n#\n# IPTABLES\n#')
+        for rule in iptables:
+            print(rule)
+    if selection in ['ip6tables', 'fw', 'fw6', 'all']:
+        print('#\n#\n# IP6TABLES\n#')
+        for rule in ip6tables:
+            print(rule)
+    return 0
+
 def apply_subcommands(args, config):
-    with fwgen.Rollback(config) as fw:
+    from fwgen import fwgen
+    with fwgen.Rollback(config, parallel=args.parallel, cache=not args.no_cache,
+                        cache_salt=args.config_json) as fw:
         if args.clear:
             LOGGER.warning('Clearing the firewall...')
             fw.clear()
@@ -111,7 +146,9 @@ def apply_subcommands(args, config):
             fw.restore_archived(args.archive)
         else:
             LOGGER.info('Applying ruleset...')
-            fw.apply()
+            fw.apply(args.force, args.delta)
+            if fw.skipped:
+                LOGGER.info('Skipped unchanged rulesets: %s', ', '.join(fw.skipped))
             LOGGER.info('Ruleset applied!')
 
         if not args.no_diff:
@@ -138,17 +175,55 @@ def apply_subcommands(args, config):
                 fw.archive()
             LOGGER.info('Ruleset saved!')
 
+        if args.timings:
+            for stage, seconds in fw.timings.items():
+                LOGGER.info('%s: %.3f seconds', stage, seconds)
+
+def analyze_subcommands(args, config):
+    from fwgen import fwgen
+    fw = fwgen.FwGen(config)
+
+    if args.interval:
+        LOGGER.info('Collecting packet counters for %d seconds...', args.interval)
+    report = fw.analyze(args.interval)
+
+    for family, chains in report.items():
+        print('#\n#\n# %s\n#' % family.upper())
+        packets = sum(i['packets'] for i in chains)
+        if not packets:
+            print('No packets counted')
+            continue
+
+        for chain in chains:
+            print('%s/%s: %.2f -> %.2f rules per packet (%d packets)'
+                  % (chain['table'], chain['chain'], chain['before'] / chain['packets'],
+                     chain['after'] / chain['packets'], chain['packets']))
+            if chain['order']:
+                print('  Suggested order:')
+                for rule, hits in chain['order']:
+                    print('  %12d  %s' % (hits, rule))
+
+        print('Average rules traversed per packet: %.2f -> %.2f'
+              % (sum(i['before'] for i in chains) / packets,
+                 sum(i['after'] for i in chains) / packets))
+    return 0
+
 def _main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--create-config-dir', metavar='PATH', default=False, nargs='?',
-                        const=Path('/etc/fwgen'), help='Create initial config dir')
+                        const='/etc/fwgen', help='Create initial config dir')
     parser.add_argument('--config', metavar='PATH', default='/etc/fwgen/config.yml',
                         help='Override path to config file')
     parser.add_argument('--defaults', metavar='PATH',
-                        default=str(Path(fwgen.__file__).parent / 'etc/defaults.yml'),
+                        default=DEFAULTS_FILE,
                         help='Override path to defaults file')
     parser.add_argument('--config-json', metavar='JSON', default=None,
                         help='JSON formatted config')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use or update the generated ruleset cache')
+    parser.add_argument('--config-cache', action='store_true',
+                        help='Cache the parsed config files in %s for faster startup'
+                        % CONFIG_CACHE_DIR)
     parser.add_argument('--version', action='store_true', help='Show version')
     parser.add_argument(
         '--log-level',
@@ -172,6 +247,14 @@ def _main():
     apply_parser.add_argument('--no-save', action='store_true',
                               help='Apply the ruleset but do not make it persistent. This also '
                                    'includes archiving.')
+    apply_parser.add_argument('--force', action='store_true',
+                              help='Apply all rulesets, including unchanged ones')
+    apply_parser.add_argument('--delta', action='store_true',
+                              help='Only update the changed chains and ipset entries')
+    apply_parser.add_argument('--parallel', action='store_true',
+                              help='Run the independent IPv4 and IPv6 operations concurrently')
+    apply_parser.add_argument('--timings', action='store_true',
+                              help='Show the wall-clock time spent in each stage')
     apply_mutex_1 = apply_parser.add_mutually_exclusive_group()
     apply_mutex_1.add_argument('--clear', action='store_true', help='Clear the ruleset')
     apply_mutex_1.add_argument('--restore', action='store_true', default=False,
@@ -185,6 +268,14 @@ def _main():
                                help="Don't ask for confirmation before storing ruleset")
     apply_parser.set_defaults(func=apply_subcommands)
 
+    # analyze commands subparser
+    analyze_parser = subparsers.add_parser(
+        'analyze', help='suggest a rule order based on the packet counters')
+    analyze_parser.add_argument('--interval', metavar='SECONDS', type=int, default=60,
+                                help='Time to collect packet counters for. Use 0 to use '
+                                     'the counters since the ruleset was applied.')
+    analyze_parser.set_defaults(func=analyze_subcommands)
+
     # show commands subparser
     show_parser = subparsers.add_parser('show', help='show configuration')
     show_subparsers = show_parser.add_subparsers(title='subcommands')
@@ -217,6 +308,25 @@ def _main():
     )
     running_parser.set_defaults(func=running_subcommands)
 
+    # generated subparser
+    generated_parser = show_subparsers.add_parser('generated',
+                                                  help='show generated configuration')
+    generated_parser.add_argument(
+        'select',
+        nargs='?',
+        choices=[
+            'iptables',
+            'fw4',
+            'ip6tables',
+            'fw6',
+            'fw',
+            'ipsets',
+            'all',
+        ],
+        help='Show specific configuration'
+    )
+    generated_parser.set_defaults(func=generated_subcommands)
+
     args = parser.parse_args()
 
     # Set up logging
@@ -232,6 +342,8 @@ def _main():
             return 0
 
         if args.create_config_dir is not False:
+            from pathlib import Path
+            from fwgen import fwgen
             configdir = fwgen.ConfigDir(Path(args.create_config_dir))
             configdir.create()
             return 0
@@ -246,13 +358,19 @@ def _main():
                 parser.print_help()
             return 1
 
-        config = merge_config(args.defaults, args.config, args.config_json)
-        LOGGER.debug('Resulting config: %s', json.dumps(config, indent=4))
+        config = merge_config(args.defaults, args.config, args.config_json,
+                              CONFIG_CACHE_DIR if args.config_cache else None)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            import json
+            from fwgen.helpers import json_default
+            LOGGER.debug('Resulting config: %s',
+                         json.dumps(config, indent=4, default=json_default))
 
         args.func(args, config)
     except TimeoutExpired:
         return 1
     except Exception as e:
+        import traceback
         LOGGER.debug(traceback.format_exc())
         LOGGER.error(e)
         return 1
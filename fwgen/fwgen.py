@@ -3,17 +3,23 @@ import subprocess
 import logging
 import shutil
 import shlex
-import ipaddress
-import difflib
 import textwrap
 import os
-import tarfile
-from datetime import datetime
+import time
+import json
+import hashlib
+import ipaddress
 from collections import OrderedDict
 from pathlib import Path
 from operator import attrgetter
+from itertools import product
+
+# Modules only needed by some subcommands, like tarfile and difflib, are
+# imported where they are used to keep the CLI startup fast
 
-from fwgen.helpers import ordered_dict_merge, random_word, run_command
+from fwgen.helpers import (LayeredDict, json_default, random_word, run_command,
+                           aggregate_networks)
+from fwgen.version import __version__
 
 
 LOGGER = logging.getLogger(__name__)
@@ -24,6 +30,10 @@ DEFAULT_CHAINS = OrderedDict([
     ('raw', ['PREROUTING', 'OUTPUT']),
     ('security', ['INPUT', 'FORWARD', 'OUTPUT'])
 ])
+IPSET_DEFAULT_HASHSIZE = 1024
+IPSET_DEFAULT_MAXELEM = 65536
+# Fraction of maxelem where a warning is given
+IPSET_MAXELEM_WARNING = 0.9
 
 
 class InvalidChain(Exception):
@@ -43,6 +53,8 @@ class NonExistingArchiveError(Exception):
 
 
 class Ruleset(object):
+    chunk_size = 65536
+
     def __init__(self):
         self.save_cmd = None
         self.restore_cmd = None
@@ -53,16 +65,52 @@ class Ruleset(object):
         LOGGER.debug("Applying %s rules", self.ruleset_type)
         self._apply(rules)
 
-    def _apply(self, rules):
-        data = '%s\n' % '\n'.join(rules)
-        #print(self.restore_cmd)
-        #print(data)
-        if self.restore_cmd != [None]:
-            p = subprocess.Popen(self.restore_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 universal_newlines=True)
-            stderr = p.communicate(data)[1]
-            if p.returncode != 0:
-                raise RulesetError(stderr)
+    def _apply(self, rules, options=()):
+        if self.restore_cmd == [None]:
+            return
+
+        import tempfile
+
+        # stderr goes to a file to avoid a deadlock if the command fills up the
+        # stderr pipe while we are still feeding it rules
+        with tempfile.TemporaryFile() as stderr:
+            p = subprocess.Popen(self.restore_cmd + list(options), stdin=subprocess.PIPE,
+                                 stderr=stderr)
+            try:
+                self._write_rules(p.stdin, rules)
+            except BrokenPipeError:
+                # The command exited early. The error is found in stderr.
+                pass
+            except BaseException:
+                # Never let the command commit a partial ruleset
+                p.kill()
+                p.wait()
+                raise
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+            if p.wait() != 0:
+                stderr.seek(0)
+                raise RulesetError(stderr.read().decode('utf-8', 'replace'))
+
+    def _write_rules(self, f, rules):
+        """
+        Stream the rules in chunks to avoid holding the complete payload in memory
+        """
+        chunk = []
+        size = 0
+        for rule in rules:
+            line = '%s\n' % rule
+            chunk.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                f.write(''.join(chunk).encode('utf-8'))
+                chunk = []
+                size = 0
+        f.write(''.join(chunk).encode('utf-8'))
 
     def restore(self, path=None):
         path = path or self.restore_file
@@ -72,7 +120,8 @@ class Ruleset(object):
     @staticmethod
     def _get_restore_rules(path):
         with path.open('r') as f:
-            return f.readlines()
+            for line in f:
+                yield line.rstrip('\n')
 
     def save(self, path):
         LOGGER.debug("Saving %s rules to '%s'", self.ruleset_type, path)
@@ -108,6 +157,26 @@ class Ruleset(object):
         for i in diff:
             yield i
 
+    def _normalize(self, rules, digest):
+        """
+        Normalize the rules the same way as for diffs while updating the digest
+        """
+        for rule in self._diff_filter(i.rstrip('\n') for i in rules):
+            digest.update(('%s\n' % rule).encode('utf-8'))
+            yield rule
+
+    def digest(self, rules):
+        digest = hashlib.sha256()
+        for _ in self._normalize(rules, digest):
+            pass
+        return digest.hexdigest()
+
+    def summary(self, rules):
+        """
+        Summary of the rules used to detect changes between applies
+        """
+        return {'digest': self.digest(rules)}
+
     def diff(self, rules, reverse=False):
         if reverse:
             old = self._diff_filter(self.running())
@@ -116,10 +185,140 @@ class Ruleset(object):
             old = self._diff_filter(rules)
             new = self._diff_filter(self.running())
 
+        import difflib
         return difflib.unified_diff(list(old), list(new), lineterm='')
 
 
 class IptablesCommon(Ruleset):
+    jump_options = ['-j', '--jump', '-g', '--goto']
+
+    def apply(self, rules, noflush=False):
+        if noflush:
+            LOGGER.debug("Applying %s rules without flushing", self.ruleset_type)
+            self._apply(rules, ['--noflush'])
+        else:
+            super().apply(rules)
+
+    def summary(self, rules):
+        digest = hashlib.sha256()
+        chains = self.chains(self._normalize(rules, digest))
+        return {'digest': digest.hexdigest(), 'chains': chains}
+
+    @classmethod
+    def chains(cls, rules):
+        """
+        Summarize every chain in the rules by its policy, a digest of its rules and
+        the chains it jumps to. The summary is used to find the changed chains
+        between two rulesets.
+        """
+        tables = OrderedDict()
+        chains = None
+
+        def get_chain(chain):
+            return chains.setdefault(chain, {
+                'policy': '-',
+                'digest': hashlib.sha256(),
+                'targets': set()
+            })
+
+        for rule in rules:
+            if rule.startswith('*'):
+                chains = tables.setdefault(rule[1:], OrderedDict())
+            elif rule.startswith(':'):
+                chain, policy = rule[1:].split()[:2]
+                get_chain(chain)['policy'] = policy
+            elif rule.startswith('-A '):
+                tokens = rule.split()
+                summary = get_chain(tokens[1])
+                summary['digest'].update(('%s\n' % rule).encode('utf-8'))
+                for i, token in enumerate(tokens[:-1]):
+                    if token in cls.jump_options:
+                        summary['targets'].add(tokens[i + 1])
+
+        # Only keep the targets that are chains in the same table, as jumps to
+        # targets like ACCEPT or LOG are just part of the chain content.
+        for chains in tables.values():
+            for summary in chains.values():
+                summary['digest'] = summary['digest'].hexdigest()
+                summary['targets'] = sorted(i for i in summary['targets'] if i in chains)
+
+        return tables
+
+    @staticmethod
+    def delta(rules, old, new):
+        """
+        Build a restore payload for use with --noflush that only flushes and
+        repopulates the chains that differ between the old and new chain summaries.
+        None is returned if chains are added or removed, or if the references
+        between chains change, as that requires a full restore.
+        """
+        if set(old) != set(new):
+            return None
+
+        changed = set()
+        for table, chains in new.items():
+            if set(old[table]) != set(chains):
+                return None
+            for chain, summary in chains.items():
+                if old[table][chain]['targets'] != summary['targets']:
+                    return None
+                if old[table][chain] != summary:
+                    changed.add((table, chain))
+
+        chain_rules = OrderedDict((i, []) for i in sorted(changed))
+        table = None
+        for rule in rules:
+            if rule.startswith('*'):
+                table = rule[1:]
+            elif rule.startswith('-A '):
+                key = (table, rule.split(maxsplit=2)[1])
+                if key in chain_rules:
+                    chain_rules[key].append(rule)
+
+        output = []
+        for table, chains in new.items():
+            changed_chains = [i for i in chains if (table, i) in changed]
+            if not changed_chains:
+                continue
+
+            output.append('*%s' % table)
+            for chain in changed_chains:
+                LOGGER.debug("Updating chain '%s' in table '%s'", chain, table)
+                if chains[chain]['policy'] != '-':
+                    output.append(':%s %s' % (chain, chains[chain]['policy']))
+                output.append('-F %s' % chain)
+                output.extend(chain_rules[(table, chain)])
+            output.append('COMMIT')
+
+        return output
+
+    def counters(self):
+        """
+        Returns the packet counters of the running ruleset as an ordered dict of
+        (table, chain) -> {'policy': packets, 'rules': [packets, ...]}. The
+        policy packets are None for chains without a policy.
+        """
+        counters = OrderedDict()
+        if self.save_cmd == [None]:
+            return counters
+
+        table = None
+        for line in run_command(self.save_cmd + ['-c']).splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith(':'):
+                chain, policy, counter = (line[1:].split() + ['', ''])[:3]
+                packets = None
+                if policy != '-' and counter.startswith('['):
+                    packets = int(counter[1:].split(':')[0])
+                counters[(table, chain)] = {'policy': packets, 'rules': []}
+            elif line.startswith('['):
+                counter, rule = line.split(' ', 1)
+                chain = rule.split(maxsplit=2)[1]
+                summary = counters.setdefault((table, chain), {'policy': None, 'rules': []})
+                summary['rules'].append(int(counter[1:].split(':')[0]))
+        return counters
+
     def clear(self):
         LOGGER.debug("Clearing %s rules", self.ruleset_type)
         rules = []
@@ -165,6 +364,10 @@ class Ip6tables(IptablesCommon):
 
 
 class Ipsets(Ruleset):
+    flag_options = ['counters', 'comment', 'skbinfo', 'forceadd']
+    sizing_options = ['hashsize', 'maxelem', 'bucketsize', 'initval', 'size']
+    counters_regex = re.compile(r' packets [0-9]+ bytes [0-9]+')
+
     def __init__(self, ipset='ipset'):
         super().__init__()
         self.ipset = ipset
@@ -184,29 +387,41 @@ class Ipsets(Ruleset):
     def _get_ipset_tmp_name(ipset):
         return '%s.%s' % (ipset, random_word(3))
 
-    def apply(self, rules):
+    def apply(self, rules, delta=False):
+        if delta:
+            LOGGER.debug("Applying %s rules as entry changes", self.ruleset_type)
+            self._apply(self._delta(rules), ['-exist'])
+            return
+
         LOGGER.debug("Applying %s rules", self.ruleset_type)
+        self._apply(self._replace(rules))
+
+    def _replace(self, rules):
+        """
+        Yield restore lines that atomically replace existing ipsets by creating
+        a temporary copy and swapping it in
+        """
         current_ipsets = self.list()
-        output = []
-        tmp_ipsets = {}
+        current = set(current_ipsets)
+        tmp_ipsets = OrderedDict()
         cur = None
 
         for rule in rules:
-            ipset = rule.split(maxsplit=2)[1]
-            if ipset in current_ipsets:
+            command, ipset, args = self._split(rule)
+            if ipset in current:
                 if ipset != cur:
                     tmp = self._get_ipset_tmp_name(ipset)
-                    while tmp in current_ipsets:
+                    while tmp in current:
                         tmp = self._get_ipset_tmp_name(ipset)
                     tmp_ipsets[ipset] = tmp
-                output.append(rule.replace(ipset, tmp_ipsets[ipset], 1))
+                yield ' '.join(i for i in [command, tmp_ipsets[ipset], args] if i)
             else:
-                output.append(rule)
+                yield rule
             cur = ipset
 
         for ipset, tmp in tmp_ipsets.items():
-            output.append('swap %s %s' % (tmp, ipset))
-            output.append('destroy %s' % tmp)
+            yield 'swap %s %s' % (tmp, ipset)
+            yield 'destroy %s' % tmp
 
         # Remove any leftover ipsets that we no longer need.
         # List sets causes errors if the referenced ipsets are removed before the
@@ -214,13 +429,131 @@ class Ipsets(Ruleset):
         # them, so we need two passes.
         destroy = [i for i in current_ipsets if i not in tmp_ipsets]
 
+        for ipset in destroy:
+            yield 'flush %s' % ipset
+
+        for ipset in destroy:
+            yield 'destroy %s' % ipset
+
+    @staticmethod
+    def _split(rule):
+        """
+        Split an ipset restore line into the command, ipset name and
+        arguments, where missing parts are empty strings
+        """
+        parts = rule.split(maxsplit=2)
+        return parts + [''] * (3 - len(parts))
+
+    @classmethod
+    def _parse(cls, rules):
+        """
+        Parse ipset restore lines into an ordered dict of ipset name ->
+        (create arguments, list of entries)
+        """
+        ipsets = OrderedDict()
+        for rule in rules:
+            command, ipset, args = cls._split(rule)
+            if command == 'create':
+                ipsets[ipset] = (args, [])
+            elif command == 'add' and args:
+                ipsets[ipset][1].append(args)
+        return ipsets
+
+    @classmethod
+    def _parse_options(cls, args):
+        """
+        Split the create arguments into the set type and a dict of options
+        """
+        tokens = args.split()
+        options = {}
+        i = 1
+        while i < len(tokens):
+            if tokens[i] in cls.flag_options:
+                options[tokens[i]] = True
+                i += 1
+            else:
+                options[tokens[i]] = ' '.join(tokens[i + 1:i + 2])
+                i += 2
+        return tokens[0], options
+
+    @classmethod
+    def _is_compatible(cls, args, running_args):
+        """
+        Check if an existing ipset can be updated in place. The type and every
+        option given must match the running ipset. Options only present in the
+        running ipset must be sizing options added by ipset itself. The hash
+        size grows as needed and is ignored, and the running maxelem only has to
+        be large enough, as these are sized automatically from the entries.
+        """
+        ipset_type, options = cls._parse_options(args)
+        running_type, running_options = cls._parse_options(running_args)
+        options.setdefault('family', 'inet')
+
+        if ipset_type != running_type:
+            return False
+
+        for option, value in running_options.items():
+            if option not in options and option not in cls.sizing_options:
+                return False
+
+        for option, value in options.items():
+            if option == 'hashsize':
+                continue
+            if option == 'maxelem':
+                if int(running_options.get('maxelem', IPSET_DEFAULT_MAXELEM)) < int(value):
+                    return False
+            elif option in running_options:
+                if running_options[option] != value:
+                    return False
+            elif not (option == 'family' and value == 'inet'):
+                return False
+
+        return True
+
+    def _delta(self, rules):
+        """
+        Build restore lines that only add and delete the changed entries of
+        existing ipsets. Ipsets where the type or options have changed are
+        replaced by swapping in a new copy.
+        """
+        running = self._parse(self.running())
+        generated = self._parse(rules)
+        output = []
+        tmp_ipsets = OrderedDict()
+
+        for ipset, (args, entries) in generated.items():
+            if ipset not in running:
+                output.append('create %s %s' % (ipset, args))
+                output.extend('add %s %s' % (ipset, i) for i in entries)
+            elif self._is_compatible(args, running[ipset][0]):
+                current = set(self.counters_regex.sub('', i) if ' packets ' in i else i
+                              for i in running[ipset][1])
+                new = set(entries)
+                output.extend('del %s %s' % (ipset, i) for i in sorted(current - new))
+                output.extend('add %s %s' % (ipset, i) for i in entries if i not in current)
+            else:
+                tmp = self._get_ipset_tmp_name(ipset)
+                while tmp in running:
+                    tmp = self._get_ipset_tmp_name(ipset)
+                tmp_ipsets[ipset] = tmp
+                output.append('create %s %s' % (tmp, args))
+                output.extend('add %s %s' % (tmp, i) for i in entries)
+
+        for ipset, tmp in tmp_ipsets.items():
+            output.append('swap %s %s' % (tmp, ipset))
+            output.append('destroy %s' % tmp)
+
+        # Flush before destroying to avoid errors from list sets, as when
+        # applying the full ruleset
+        destroy = [i for i in running if i not in generated]
+
         for ipset in destroy:
             output.append('flush %s' % ipset)
 
         for ipset in destroy:
             output.append('destroy %s' % ipset)
 
-        self._apply(output)
+        return output
 
     @staticmethod
     def _diff_filter(diff):
@@ -272,56 +605,390 @@ class ConfigDir(object):
 
 
 class Archive(object):
-    def __init__(self, path):
+    """
+    Content addressed store of archived rulesets. Each restore file is stored
+    once as a compressed blob named by the SHA-256 of its content, and each
+    archived ruleset is a small JSON manifest pointing at its blobs. Legacy
+    tarball archives are still listed and can be read.
+
+    With a snapshot interval above 1, a changed restore file is stored as a
+    line based delta against its previous version, and as a full blob only
+    every 'snapshot_interval' versions.
+
+    The archives are listed in an index file, which is used for listing and
+    lookups instead of scanning the directory. The index has the same mtime
+    as the directory when written, so any other change to the directory
+    makes it stale and it is rebuilt.
+    """
+    # Compression of the blobs, and the tarball suffix used for the same
+    # compression by older versions
+    suffixes = OrderedDict([
+        ('xz', '.tar.xz'),
+        ('gz', '.tar.gz'),
+        ('bz2', '.tar.bz2'),
+        ('none', '.tar'),
+    ])
+
+    def __init__(self, path, compression='xz', level=None, snapshot_interval=1):
+        if compression is None:
+            compression = 'none'
+        if compression not in self.suffixes:
+            raise ValueError("Invalid archive compression '%s'. Valid choices are: %s"
+                             % (compression, ', '.join(self.suffixes)))
+        if compression == 'none':
+            level = None
+        elif level is not None:
+            # bzip2 has no level 0
+            minimum = 1 if compression == 'bz2' else 0
+            if (not isinstance(level, int) or isinstance(level, bool)
+                    or not minimum <= level <= 9):
+                raise ValueError("Invalid archive compression level '%s' for %s. Valid "
+                                 "levels are %d-9" % (level, compression, minimum))
         self.path = path
-        self.suffix = '.tar.xz'
+        self.blobs = path / 'blobs'
+        self.compression = compression
+        self.level = level
+        self.snapshot_interval = snapshot_interval
+        self.suffix = '.json'
+        self.delta_suffix = '.delta'
         self.tmp_suffix = '.tmp'
+        self.index = path / 'index'
+        self._lines = None
+        self._names = None
+        self._index_mtime = None
 
     def create(self):
         try:
-            self.path.mkdir(parents=True)
+            self.blobs.mkdir(parents=True)
         except FileExistsError:
             pass
 
-    def new(self):
-        timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
-        path = self.path / Path('%s%s' % (timestamp, self.suffix))
-        return ArchiveFile(path)
+    def _write(self, path, data):
+        """ Write the file atomically, so partial files are never used """
+        tmp = Path(str(path) + self.tmp_suffix)
+        with os.fdopen(os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                       'wb') as f:
+            f.write(data)
+        tmp.rename(path)
+
+    def _compress(self, data):
+        if self.compression == 'xz':
+            import lzma
+            return lzma.compress(data, preset=self.level)
+        if self.compression == 'gz':
+            import gzip
+            return gzip.compress(data, compresslevel=9 if self.level is None else self.level)
+        if self.compression == 'bz2':
+            import bz2
+            return bz2.compress(data, compresslevel=9 if self.level is None else self.level)
+        return data
 
-    def get_all(self):
+    @staticmethod
+    def _decompress(data):
+        """ The compression is detected from the data, so it can be changed any time """
+        if data.startswith(b'\xfd7zXZ\x00'):
+            import lzma
+            return lzma.decompress(data)
+        if data.startswith(b'\x1f\x8b'):
+            import gzip
+            return gzip.decompress(data)
+        if data.startswith(b'BZh'):
+            import bz2
+            return bz2.decompress(data)
+        return data
+
+    def _blob_exists(self, digest):
+        return ((self.blobs / digest).exists() or
+                (self.blobs / (digest + self.delta_suffix)).exists())
+
+    def _read_delta(self, digest):
+        with (self.blobs / (digest + self.delta_suffix)).open('rb') as f:
+            return json.loads(self._decompress(f.read()).decode('utf-8'))
+
+    def _get_depth(self, digest):
+        """ Number of deltas to apply to get the content of the blob """
+        if (self.blobs / digest).exists():
+            return 0
+        return self._read_delta(digest)['depth']
+
+    def read_blob(self, digest):
+        # Follow the deltas back to the full blob, then apply them in order
+        deltas = []
+        while not (self.blobs / digest).exists():
+            delta = self._read_delta(digest)
+            deltas.append(delta['ops'])
+            digest = delta['base']
+
+        with (self.blobs / digest).open('rb') as f:
+            data = self._decompress(f.read())
+
+        if not deltas:
+            return data
+
+        lines = data.decode('utf-8').splitlines(True)
+        for ops in reversed(deltas):
+            base = lines
+            lines = []
+            for op in ops:
+                if isinstance(op, list):
+                    lines.extend(base[op[0]:op[1]])
+                else:
+                    lines.append(op)
+        return ''.join(lines).encode('utf-8')
+
+    def _make_delta(self, base, data):
+        """
+        Line based delta from the base blob. Unchanged line ranges are stored
+        as [start, end] in the base, and other lines as strings. Runs of lines
+        are copied from the first position of their first line in the base, so
+        the delta is made in linear time even for very large rulesets.
+        """
+        base_lines = self.read_blob(base).decode('utf-8').splitlines(True)
+        lines = data.decode('utf-8').splitlines(True)
+        positions = {}
+        for i, line in enumerate(base_lines):
+            positions.setdefault(line, i)
+
+        ops = []
+        start = end = None
+        for line in lines:
+            if end is not None:
+                if end < len(base_lines) and base_lines[end] == line:
+                    end += 1
+                    continue
+                ops.append([start, end])
+                start = end = None
+
+            i = positions.get(line)
+            if i is None:
+                ops.append(line)
+            else:
+                start, end = i, i + 1
+
+        if end is not None:
+            ops.append([start, end])
+        return ops
+
+    def _add_blob(self, digest, data, base=None):
+        if self.snapshot_interval > 1 and base is not None and self._blob_exists(base):
+            depth = self._get_depth(base) + 1
+            if depth < self.snapshot_interval:
+                delta = {'base': base, 'depth': depth, 'ops': self._make_delta(base, data)}
+                blob = self.blobs / (digest + self.delta_suffix)
+                LOGGER.debug("Archiving delta blob '%s'", blob)
+                self._write(blob, self._compress(json.dumps(delta).encode('utf-8')))
+                return
+
+        blob = self.blobs / digest
+        LOGGER.debug("Archiving blob '%s'", blob)
+        self._write(blob, self._compress(data))
+
+    def add(self, iptables, ip6tables, ipsets):
+        """
+        Archive the restore files. Nothing is added if they are identical to
+        the latest archived ruleset, and the latest archive is returned instead.
+        """
+        from datetime import datetime
+
+        files = OrderedDict()
+        for name, path in zip(ArchiveSnapshot.files, [iptables, ip6tables, ipsets]):
+            with path.open('rb') as f:
+                data = f.read()
+            files[name] = (hashlib.sha256(data).hexdigest(), data)
+        digests = OrderedDict((name, digest) for name, (digest, _) in files.items())
+        sizes = OrderedDict((name, len(data)) for name, (_, data) in files.items())
+
+        lines = self._load_index()
+        latest = self._from_index_line(lines[0]) if lines else None
+        if not isinstance(latest, ArchiveSnapshot):
+            latest = None
+        elif latest.digests() == digests:
+            LOGGER.info("Ruleset is unchanged since archive '%s'", latest.name)
+            return latest
+
+        for name, (digest, data) in files.items():
+            if not self._blob_exists(digest):
+                self._add_blob(digest, data, latest.digests().get(name) if latest else None)
+
+        # Names include microseconds, and are never reused, so rulesets archived
+        # within the same second do not replace each other
+        path = None
+        while path is None or path.exists():
+            timestamp = datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+            path = self.path / Path('%s%s' % (timestamp, self.suffix))
+        LOGGER.debug("Archiving ruleset to '%s'", path)
+        manifest = OrderedDict([('files', digests), ('sizes', sizes)])
+        self._write(path, json.dumps(manifest, indent=2).encode('utf-8'))
+        snapshot = ArchiveSnapshot(path, self, manifest)
+
+        lines = [self._index_line(snapshot)] + [i for i in lines
+                                                if self._index_name(i) != snapshot.name]
+        self._save_index(sorted(lines, key=self._index_name, reverse=True))
+        return snapshot
+
+    def _scan(self):
+        suffixes = tuple(self.suffixes.values())
+        archive_files = []
+        for path in self.path.glob('*.tar*'):
+            if path.name.endswith(suffixes):
+                archive_files.append(ArchiveFile(path))
         for path in self.path.glob('*%s' % self.suffix):
-            yield ArchiveFile(path)
+            archive_files.append(ArchiveSnapshot(path, self))
+        return sorted(archive_files, key=attrgetter('name'), reverse=True)
+
+    @staticmethod
+    def _index_line(archive_file):
+        """
+        Index line with the name, the archive time in seconds since the epoch,
+        the restore file digests and the restore file sizes, tab separated.
+        Unknown values are '-'.
+        """
+        digests = sizes = '-'
+        if isinstance(archive_file, ArchiveSnapshot):
+            digests = ','.join(archive_file.digests()[i] for i in ArchiveSnapshot.files)
+            if archive_file.sizes():
+                sizes = ','.join(str(archive_file.sizes()[i]) for i in ArchiveSnapshot.files)
+        timestamp = '%d' % archive_file.path.stat().st_mtime
+        return '\t'.join([archive_file.name, timestamp, digests, sizes])
+
+    @staticmethod
+    def _index_name(line):
+        return line.split('\t', 1)[0]
+
+    def _from_index_line(self, line):
+        name, _, digests, sizes = line.split('\t')
+        path = self.path / name
+        if digests == '-':
+            return ArchiveFile(path)
+
+        manifest = OrderedDict([
+            ('files', OrderedDict(zip(ArchiveSnapshot.files, digests.split(',')))),
+            ('sizes', None),
+        ])
+        if sizes != '-':
+            manifest['sizes'] = OrderedDict(zip(ArchiveSnapshot.files,
+                                                (int(i) for i in sizes.split(','))))
+        return ArchiveSnapshot(path, self, manifest)
+
+    def _set_index(self, lines, mtime):
+        self._lines = lines
+        self._names = None
+        self._index_mtime = mtime
+
+    def _save_index(self, lines):
+        mtime = None
+        try:
+            self._write(self.index, ''.join('%s\n' % i for i in lines).encode('utf-8'))
+            mtime = self.path.stat().st_mtime_ns
+            os.utime(str(self.index), ns=(mtime, mtime))
+        except OSError as e:
+            LOGGER.debug("Unable to write archive index '%s': %s", self.index, e)
+        self._set_index(lines, mtime)
+
+    def _load_index(self, rebuild=False):
+        """
+        The index lines of the archives sorted with the latest first. Entries
+        are only parsed when used, so lookups do not depend on the history size.
+        """
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        if not rebuild and self._lines is not None and self._index_mtime == mtime:
+            return self._lines
+
+        if not rebuild:
+            try:
+                if self.index.stat().st_mtime_ns == mtime:
+                    with self.index.open('r') as f:
+                        lines = f.read().splitlines()
+                    if all(i.count('\t') == 3 for i in lines):
+                        self._set_index(lines, mtime)
+                        return lines
+            except FileNotFoundError:
+                pass
+
+        LOGGER.debug("Rebuilding archive index '%s'", self.index)
+        lines = [self._index_line(i) for i in self._scan()]
+        self._save_index(lines)
+        return lines
+
+    def get_all(self):
+        return (self._from_index_line(i) for i in self._load_index())
 
     def get_all_indexed(self):
-        archive_files = sorted(self.get_all(), key=attrgetter('name'), reverse=True)
-        for index, archive_file in enumerate(archive_files):
-            yield (index, archive_file)
+        return enumerate(self.get_all())
 
-    def clean(self, keep=0):
+    def gc(self, keep=0):
+        """
+        Remove all but the latest 'keep' archives, and then every blob not
+        referenced by the remaining archives, directly or as the base of a delta.
+        The archives are found by scanning the directory.
+        """
         if keep < 0:
             raise ValueError('keep value must be an integer 0 or more')
 
         for tmp in self.path.glob('*%s' % self.tmp_suffix):
             tmp.unlink()
+        for tmp in self.blobs.glob('*%s' % self.tmp_suffix):
+            tmp.unlink()
 
-        archive_files = sorted(self.get_all(), key=attrgetter('name'), reverse=True)
-        for archive_file in archive_files[keep:]:
-            archive_file.remove()
+        # Blobs are removed based on the archives found, so the index is rebuilt
+        # from the directory instead of being trusted
+        lines = self._load_index(rebuild=True)
+        for line in lines[keep:]:
+            self._from_index_line(line).remove()
+        if lines[keep:]:
+            self._save_index(lines[:keep])
+
+        referenced = set()
+        for line in lines[:keep]:
+            digests = line.split('\t')[2]
+            if digests != '-':
+                referenced.update(digests.split(','))
+
+        pending = list(referenced)
+        while pending:
+            digest = pending.pop()
+            if (self.blobs / (digest + self.delta_suffix)).exists():
+                base = self._read_delta(digest)['base']
+                if base not in referenced:
+                    referenced.add(base)
+                    pending.append(base)
+
+        for blob in self.blobs.iterdir():
+            digest = blob.name
+            if digest.endswith(self.delta_suffix):
+                digest = digest[:-len(self.delta_suffix)]
+            if digest not in referenced:
+                LOGGER.debug("Removing unreferenced blob '%s'", blob)
+                blob.unlink()
 
     def get_by_index(self, index):
         """
         The archive files must be sorted the same way as the 'archive --list' output
         to ensure identical index mapping
         """
-        for i, archive_file in self.get_all_indexed():
-            if i == index:
-                return archive_file
+        # Rebuild the index if it points at a missing file
+        for rebuild in [False, True]:
+            lines = self._load_index(rebuild)
+            if 0 <= index < len(lines):
+                archive_file = self._from_index_line(lines[index])
+                if archive_file.path.exists():
+                    return archive_file
         raise NonExistingArchiveError("The archive file index '%d' does not exist" % index)
 
     def get_by_name(self, name):
-        for archive_file in self.get_all():
-            if archive_file.name == name:
-                return archive_file
+        # Rebuild the index if the name is missing or points at a missing file
+        for rebuild in [False, True]:
+            lines = self._load_index(rebuild)
+            if self._names is None:
+                self._names = dict((self._index_name(i), i) for i in lines)
+            if name in self._names:
+                archive_file = self._from_index_line(self._names[name])
+                if archive_file.path.exists():
+                    return archive_file
         raise NonExistingArchiveError("The archive file named '%s' does not exist" % name)
 
     def get(self, name):
@@ -334,35 +1001,88 @@ class Archive(object):
         return self.get_by_name(name)
 
 
+class ArchiveSnapshot(object):
+    """ Archived ruleset stored as a manifest of blobs in an Archive """
+    files = ['iptables.restore', 'ip6tables.restore', 'ipsets.restore']
+
+    def __init__(self, path, archive, manifest=None):
+        self.path = path
+        self.name = path.name
+        self._archive = archive
+        self._manifest = manifest
+
+    def manifest(self):
+        if self._manifest is None:
+            with self.path.open('r') as f:
+                self._manifest = json.load(f, object_pairs_hook=OrderedDict)
+        return self._manifest
+
+    def digests(self):
+        return self.manifest()['files']
+
+    def sizes(self):
+        """ Sizes of the restore files, not stored by older manifests """
+        return self.manifest().get('sizes')
+
+    def remove(self):
+        LOGGER.debug("Removing ruleset archive '%s'", self.path)
+        self.path.unlink()
+
+    def _extract_file(self, name):
+        try:
+            digest = self.digests()[name]
+        except KeyError:
+            raise KeyError("filename '%s' not found in '%s'" % (name, self.path))
+        return self._archive.read_blob(digest).decode('utf-8').splitlines()
+
+    def iptables(self):
+        return self._extract_file('iptables.restore')
+
+    def ip6tables(self):
+        return self._extract_file('ip6tables.restore')
+
+    def ipsets(self):
+        return self._extract_file('ipsets.restore')
+
+
 class ArchiveFile(object):
+    """ Legacy archived ruleset stored as a tarball """
     def __init__(self, path):
         self.path = path
         self.name = path.name
         self.iptables_restore = 'iptables.restore'
         self.ip6tables_restore = 'ip6tables.restore'
         self.ipsets_restore = 'ipsets.restore'
-
-    def add(self, iptables, ip6tables, ipsets):
-        tmp = Path(str(self.path) + '.tmp')
-
-        LOGGER.debug("Archiving ruleset to '%s'", tmp)
-        with os.fdopen(os.open(str(tmp), os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as f:
-            with tarfile.open(mode='w:xz', fileobj=f) as tar:
-                tar.add(str(iptables), arcname=self.iptables_restore)
-                tar.add(str(ip6tables), arcname=self.ip6tables_restore)
-                tar.add(str(ipsets), arcname=self.ipsets_restore)
-
-        LOGGER.debug("Renaming '%s' to '%s'", tmp, self.path)
-        tmp.rename(self.path)
+        self._members = None
 
     def remove(self):
         LOGGER.debug("Removing ruleset archive '%s'", self.path)
         self.path.unlink()
 
+    def _read_members(self):
+        """
+        Read every member in a single sequential pass over the archive, so it is
+        only decompressed once no matter how many members are used. The
+        compression is autodetected.
+        """
+        import tarfile
+
+        LOGGER.debug("Reading ruleset archive '%s'", self.path)
+        members = {}
+        with tarfile.open(str(self.path), 'r|*') as tar:
+            for member in tar:
+                if member.isfile():
+                    with tar.extractfile(member) as f:
+                        members[member.name] = f.read().decode('utf-8').splitlines()
+        return members
+
     def _extract_file(self, name):
-        with tarfile.open(str(self.path), 'r:xz') as tar:
-            with tar.extractfile(name) as f:
-                return f.read().decode('utf-8').splitlines()
+        if self._members is None:
+            self._members = self._read_members()
+        try:
+            return self._members[name]
+        except KeyError:
+            raise KeyError("filename '%s' not found in '%s'" % (name, self.path))
 
     def iptables(self):
         return self._extract_file(self.iptables_restore)
@@ -374,8 +1094,160 @@ class ArchiveFile(object):
         return self._extract_file(self.ipsets_restore)
 
 
+class RulesetCache(object):
+    """
+    Persistent cache of generated rulesets. Each entry is a directory named by
+    the cache key, which is created atomically by renaming a complete temporary
+    directory into place. Only the most recent entry is kept.
+    """
+    # Cache keys, and the temporary directories used while adding them. Nothing
+    # else in the cache directory is ever removed.
+    entry_pattern = re.compile(r'^[0-9a-f]{64}(\.\d+\.tmp)?$')
+
+    def __init__(self, path):
+        self.path = path
+        self.files = ['iptables.rules', 'ip6tables.rules', 'ipsets.rules']
+
+    def get(self, key):
+        entry = self.path / key
+        if not entry.is_dir():
+            LOGGER.debug("No cached ruleset for key '%s'", key)
+            return None
+
+        LOGGER.debug("Using cached ruleset '%s'", entry)
+        return tuple(LazyRules(lambda path=entry / i: Ruleset._get_restore_rules(path))
+                     for i in self.files)
+
+    def add(self, key, *rulesets):
+        try:
+            self.path.mkdir(mode=0o700, parents=True)
+        except FileExistsError:
+            pass
+
+        tmp = self.path / Path('%s.%d.tmp' % (key, os.getpid()))
+        try:
+            tmp.mkdir(mode=0o700)
+            for name, rules in zip(self.files, rulesets):
+                with os.fdopen(os.open(str(tmp / name), os.O_WRONLY | os.O_CREAT, 0o600),
+                               'w') as f:
+                    for rule in rules:
+                        f.write('%s\n' % rule)
+
+            LOGGER.debug("Adding cached ruleset '%s'", self.path / key)
+            tmp.rename(self.path / key)
+        except OSError:
+            # Most likely added by a concurrent run already
+            if not (self.path / key).is_dir():
+                raise
+        finally:
+            shutil.rmtree(str(tmp), ignore_errors=True)
+
+        self.clean(keep=key)
+
+    def clean(self, keep=None):
+        for entry in self.path.iterdir():
+            if entry.name != keep and self.entry_pattern.match(entry.name):
+                LOGGER.debug("Removing cached ruleset '%s'", entry)
+                shutil.rmtree(str(entry), ignore_errors=True)
+
+
+class RuleTemplate(object):
+    """
+    A rule tokenized once into literal parts and ${object} and %{zone}
+    placeholders. The placeholders are replaced in place when expanding the rule.
+    """
+    placeholder_pattern = re.compile(r'([$%])\{(.+?)\}')
+
+    def __init__(self, rule):
+        self.parts = []
+        self.objects = []
+        self.zones = []
+        pos = 0
+
+        for match in self.placeholder_pattern.finditer(rule):
+            self.parts.append(rule[pos:match.start()])
+            slot = (len(self.parts), match.group(2))
+            if match.group(1) == '$':
+                self.objects.append(slot)
+            else:
+                self.zones.append(slot)
+            self.parts.append(match.group(0))
+            pos = match.end()
+
+        self.parts.append(rule[pos:])
+
+
+class LazyRules(object):
+    """
+    Rules that are produced from scratch on each iteration, such as by reading
+    a file, so that large rulesets never have to be held in memory
+    """
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __iter__(self):
+        return iter(self.generator())
+
+
+class AddressFamilyIndex(object):
+    """
+    The address family of object values, classified once per config. Lookups
+    of values not added up front are classified and indexed on first use.
+    """
+    def __init__(self):
+        self._families = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _classify(value):
+        if FwGen._is_ipv4_addr(value):
+            return 4
+        if FwGen._is_ipv6_addr(value):
+            return 6
+        return None
+
+    def add(self, value):
+        try:
+            if value not in self._families:
+                self._families[value] = self._classify(value)
+        except TypeError:
+            # Unhashable values are classified on lookup instead
+            pass
+
+    def lookup(self, value):
+        try:
+            family = self._families[value]
+        except KeyError:
+            self.misses += 1
+            family = self._families[value] = self._classify(value)
+            return family
+        except TypeError:
+            self.misses += 1
+            return self._classify(value)
+        self.hits += 1
+        return family
+
+    def stats(self):
+        return {
+            'values': len(self._families),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
 class FwGen(object):
-    def __init__(self, config):
+    address_option_pattern = re.compile(r'(?:^|(?<=\s))(-s|--source|-d|--destination)\s+$')
+    comment_pattern = re.compile(r'(^| )-m comment --comment ("[^"]*"|\S+)')
+    terminal_targets = ['ACCEPT', 'DROP', 'REJECT', 'RETURN']
+    passive_targets = ['LOG', 'NFLOG']
+    stateful_matches = ['limit', 'hashlimit', 'recent', 'statistic', 'quota', 'connlimit']
+    # Rule tokens, where quoted strings like comments are single tokens
+    token_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|\'[^\']*\'|\S+')
+    match_options = ['-m', '--match']
+    jump_options = ['-j', '--jump', '-g', '--goto']
+
+    def __init__(self, config, parallel=False, cache=False, cache_salt=''):
         defaults = OrderedDict()
         defaults = {
             'restore_files': {
@@ -392,11 +1264,18 @@ class FwGen(object):
             },
             'archive': {
                 'path': '/var/lib/fwgen/archive',
-                'keep': 10
+                'keep': 10,
+                'compression': 'xz',
+                'level': None,
+                'snapshot_interval': 1
+            },
+            'state_file': '/var/lib/fwgen/rules/state.json',
+            'cache': {
+                'path': '/var/lib/fwgen/cache'
             },
             'check_commands': []
         }
-        self.config = ordered_dict_merge(config, defaults)
+        self.config = LayeredDict(defaults, config)
         self.local_zone = 'local'
         self.default_zone = 'default'
         self._deprecation_check()
@@ -410,9 +1289,21 @@ class FwGen(object):
             'ip6': Path(self.config['restore_files']['ip6tables']),
             'ipset': Path(self.config['restore_files']['ipsets'])
         }
-        self.zone_pattern = re.compile(r'^(.*?)%\{(.+?)\}(.*)$')
-        self.object_pattern = re.compile(r'^(.*?)\$\{(.+?)\}(.*)$')
-        self._archive = Archive(Path(self.config['archive']['path']))
+        self.family_index = self._build_family_index()
+        self.state_file = Path(self.config['state_file'])
+        self.parallel = parallel
+        self.cache = RulesetCache(Path(self.config['cache']['path'])) if cache else None
+        self.cache_salt = cache_salt
+        self.timings = OrderedDict()
+        self.skipped = []
+        self._generated_state = None
+        self._object_values = {}
+        self._promoted_objects = None
+        self._optimize_reported = set()
+        self._archive = Archive(Path(self.config['archive']['path']),
+                                self.config['archive']['compression'],
+                                self.config['archive']['level'],
+                                self.config['archive']['snapshot_interval'])
 
     def _deprecation_check(self):
         if self.config.get('global'):
@@ -428,19 +1319,140 @@ class FwGen(object):
                                    " in v0.14.0 and newer configurations.")
 
     def _output_ipsets(self):
-        output = []
         for ipset, params in self.config.get('ipsets', {}).items():
-            create_cmd = ['create %s %s' % (ipset, params['type'])]
-            create_cmd.append(params.get('options', None))
-            output.append(' '.join([i for i in create_cmd if i]))
+            yield from self._output_ipset(ipset, params)
+
+        for sets in self._get_promoted_objects().values():
+            for family, ipset, values in sets:
+                params = {
+                    'type': 'hash:net',
+                    'options': 'family %s' % ('inet' if family == 4 else 'inet6'),
+                    'entries': values
+                }
+                yield from self._output_ipset(ipset, params)
+
+    def _output_ipset(self, ipset, params):
+        create_cmd = ['create %s %s' % (ipset, params['type'])]
+        create_cmd.append(params.get('options', None))
+
+        entries = self._get_ipset_entries(ipset, params)
+        if params.get('aggregate'):
+            entries = self._aggregate_ipset_entries(ipset, params['type'], entries)
+
+        if not params['type'].startswith('hash:'):
+            yield ' '.join([i for i in create_cmd if i])
+            yield from entries
+            return
+
+        # Hash sets are sized from the number of entries, so the entries are
+        # counted as they are generated and spooled to a file until the create
+        # command is output
+        import tempfile
+
+        with tempfile.TemporaryFile('w+') as f:
+            count = 0
+            for entry in entries:
+                f.write('%s\n' % entry)
+                count += 1
+
+            create_cmd.append(self._get_ipset_sizing(ipset, params, count))
+            yield ' '.join([i for i in create_cmd if i])
+
+            f.seek(0)
+            for line in f:
+                yield line.rstrip('\n')
+
+    @staticmethod
+    def _get_ipset_sizing(ipset, params, entries):
+        """
+        Returns hashsize and maxelem options for hash sets with the given number
+        of entries that are too large for the ipset defaults, so the set is not
+        resized while it is populated. Options set explicitly are kept as is.
+        """
+        options = Ipsets._parse_options('%s %s' % (params['type'],
+                                                   params.get('options') or ''))[1]
+
+        sizing = []
+        if 'hashsize' not in options:
+            hashsize = 1 << max(entries - 1, 0).bit_length()
+            if hashsize > IPSET_DEFAULT_HASHSIZE:
+                sizing.append('hashsize %d' % hashsize)
+
+        if 'maxelem' in options:
+            maxelem = int(options['maxelem'])
+            if entries > maxelem * IPSET_MAXELEM_WARNING:
+                LOGGER.warning("Ipset '%s' has %d entries, which is close to or above its "
+                               "maxelem of %d", ipset, entries, maxelem)
+        else:
+            # Leave room for the set to grow
+            maxelem = 2 << max(entries - 1, 0).bit_length()
+            if maxelem > IPSET_DEFAULT_MAXELEM:
+                sizing.append('maxelem %d' % maxelem)
+
+        return ' '.join(sizing)
+
+    def _get_ipset_entries(self, ipset, params):
+        for entry in params.get('entries') or []:
             try:
-                for entry in params['entries']:
-                #print(params)
-                    #print(entry)
-                    output.extend(self._expand_objects('add %s %s' % (ipset, entry), ruletype='ipset'))
-            except Exception as e:
-                print(e)
-        return output
+                yield from self._expand_objects('add %s %s' % (ipset, entry), ruletype='ipset')
+            except KeyError:
+                raise RulesetError("Undefined object in the entry '%s' of ipset '%s'"
+                                   % (entry, ipset))
+
+        if params.get('entries_file'):
+            yield from self._read_entries_file(ipset, params['entries_file'])
+
+    @staticmethod
+    def _aggregate_ipset_entries(ipset, ipset_type, entries):
+        """
+        Collapse overlapping and adjacent networks into the minimal list of
+        networks covering the same addresses
+        """
+        if ipset_type != 'hash:net':
+            LOGGER.warning("Aggregation is only supported for hash:net sets. Ignoring it "
+                           "for '%s'", ipset)
+            yield from entries
+            return
+
+        prefix = 'add %s ' % ipset
+        before = 0
+        after = 0
+
+        def strip_prefix(entries):
+            nonlocal before
+            for entry in entries:
+                before += 1
+                yield entry[len(prefix):]
+
+        for network in aggregate_networks(strip_prefix(entries)):
+            after += 1
+            yield prefix + network
+
+        LOGGER.info("Aggregated ipset '%s' from %d to %d entries", ipset, before, after)
+
+    @staticmethod
+    def _read_entries_file(ipset, path):
+        """
+        Stream the entries of a plain text file with one entry per line into
+        'add' commands. Empty lines and lines starting with '#' are skipped.
+        The entries are used as is, without object expansion.
+        """
+        LOGGER.debug("Reading ipset entries for '%s' from '%s'", ipset, path)
+        with open(path, 'r') as f:
+            for line in f:
+                entry = line.strip()
+                if entry and not entry.startswith('#'):
+                    yield 'add %s %s' % (ipset, entry)
+
+    def _get_entries_files_state(self):
+        """ The path, mtime and size of each ipset entries file """
+        state = []
+        for ipset, params in self.config.get('ipsets', {}).items():
+            path = params.get('entries_file')
+            if path:
+                st = os.stat(path)
+                state.append([ipset, path, st.st_mtime_ns, st.st_size])
+        return state
 
     def _get_policy_rules(self):
         for table, chains in DEFAULT_CHAINS.items():
@@ -594,18 +1606,11 @@ class FwGen(object):
                     for rule in items:
                         yield (table, '-A %s %s' % (target, rule))
 
-    def _expand_zones(self, rule):
-        match = re.search(self.zone_pattern, rule)
-        if match:
-            zone = match.group(2)
-
-            for interface in self.config['zones'][zone]['interfaces']:
-                rule_expanded = '%s%s%s' % (match.group(1), interface, match.group(3))
+    def _get_zone_interfaces(self, zone):
+        return [str(i) for i in self.config['zones'][zone]['interfaces']]
 
-                for rule_ in self._expand_zones(rule_expanded):
-                    yield rule_
-        else:
-            yield rule
+    def _expand_zones(self, rule):
+        yield from self._expand(RuleTemplate(rule), objects=False)
 
     @staticmethod
     def _has_option(rule, option):
@@ -615,6 +1620,16 @@ class FwGen(object):
             return True
         return False
 
+    @staticmethod
+    def _remove_option(rule, option):
+        if rule.startswith('%s ' % option):
+            return rule[len(option) + 1:]
+        if ' %s ' % option in rule:
+            return rule.replace(' %s ' % option, ' ', 1)
+        if rule.endswith(' %s' % option):
+            return rule[:-len(option) - 1]
+        return rule
+
     def _is_ipv4_rule(self, rule):
         return bool(self._has_option(rule, '-4'))
 
@@ -637,70 +1652,435 @@ class FwGen(object):
         except ipaddress.AddressValueError:
             return False
 
-    def _expand_objects(self, string, ruletype='iptables'):
-        match = re.search(self.object_pattern, string)
-        if match:
-            values = self.config['objects'][match.group(2)]
-
+    def _build_family_index(self):
+        index = AddressFamilyIndex()
+        for values in self.config.get('objects', {}).values():
             if not isinstance(values, list):
                 values = [values]
-
             for value in values:
-                string_expanded = '%s%s%s' % (match.group(1), value, match.group(3))
+                if not (isinstance(value, str) and '${' in value):
+                    index.add(value)
+        return index
+
+    def _get_object_values(self, name):
+        """
+        Returns a list of (value, is_ipv4, is_ipv6) tuples for the object. Objects
+        referencing other objects are resolved here, so each object is only
+        resolved once.
+        """
+        try:
+            return self._object_values[name]
+        except KeyError:
+            pass
 
-                # Only try to be smart if the rule is not already tagged as a IPv4 or IPv6 rule
-                if ruletype == 'iptables':
-                    if self._is_ipv4_addr(value):
-                        if self._is_ipv6_rule(string_expanded):
-                            continue
+        values = self.config['objects'][name]
+        if not isinstance(values, list):
+            values = [values]
+
+        resolved = []
+        for value in values:
+            if isinstance(value, str) and '${' in value:
+                template = RuleTemplate(value)
+                parts = list(template.parts)
+                for ipv4, ipv6 in self._resolve_objects(template.objects, parts):
+                    if not (ipv4 and ipv6):
+                        resolved.append((''.join(parts), ipv4, ipv6))
+            else:
+                family = self.family_index.lookup(value)
+                resolved.append((str(value), family == 4, family == 6))
 
-                        if not self._is_ipv4_rule(string_expanded):
-                            string_expanded = '-4 %s' % string_expanded
-                    elif self._is_ipv6_addr(value):
-                        if self._is_ipv4_rule(string_expanded):
-                            continue
+        self._object_values[name] = resolved
+        return resolved
 
-                        if not self._is_ipv6_rule(string_expanded):
-                            string_expanded = '-6 %s' % string_expanded
+    @staticmethod
+    def _get_object_ipset_name(name, family):
+        # Leave room for the suffix of the temporary ipset used when replacing it
+        ipset = 'fwgen-%s-%d' % (name, family)
+        if len(ipset) > 27 or not re.fullmatch(r'[\w.-]+', name):
+            digest = hashlib.sha256(name.encode('utf-8')).hexdigest()[:16]
+            ipset = 'fwgen-%s-%d' % (digest, family)
+        return ipset
+
+    @classmethod
+    def _match_address_option(cls, part):
+        """
+        Check if the rule part ends with a source or destination address option
+        that can be replaced by an ipset match. Returns the position of the
+        option and the ipset match direction, or None.
+        """
+        match = cls.address_option_pattern.search(part)
+        if not match or part[:match.start()].rstrip().endswith('!'):
+            return None
+        return match.start(), 'src' if match.group(1) in ['-s', '--source'] else 'dst'
 
-                for string_ in self._expand_objects(string_expanded):
-                    yield string_
-        else:
-            yield string
+    def _get_promoted_objects(self):
+        """
+        Returns the objects that are replaced by ipsets in source and
+        destination matches, as a dict of object name to a list of (family,
+        ipset, values). Only objects where every value is an IPv4 or IPv6
+        address or network, and with at least 'optimize.object_ipsets' values,
+        are promoted. This is disabled by default.
+        """
+        if self._promoted_objects is not None:
+            return self._promoted_objects
+
+        self._promoted_objects = OrderedDict()
+        threshold = self.config.get('optimize', {}).get('object_ipsets')
+        if not threshold:
+            return self._promoted_objects
+
+        for _, rule in self._get_all_rules():
+            template = RuleTemplate(rule)
+            for index, name in template.objects:
+                if (name in self._promoted_objects
+                        or not self._match_address_option(template.parts[index - 1])):
+                    continue
+
+                values = self._get_object_values(name)
+                if len(values) < threshold or any(ipv4 == ipv6 for _, ipv4, ipv6 in values):
+                    continue
+
+                sets = []
+                for family in [4, 6]:
+                    family_values = [value for value, ipv4, ipv6 in values
+                                     if (ipv4 if family == 4 else ipv6)]
+                    if family_values:
+                        sets.append((family, self._get_object_ipset_name(name, family),
+                                     family_values))
+                self._promoted_objects[name] = sets
+                LOGGER.debug("Replacing object '%s' with %d values by ipsets %s", name,
+                             len(values), ', '.join(i[1] for i in sets))
+
+        return self._promoted_objects
+
+    def _promote_objects(self, slots, parts, choices):
+        """
+        Replace address options for promoted objects with ipset matches. The
+        option is removed from the preceding part and the ipset match becomes
+        the value of the slot, once for each family.
+        """
+        promoted = self._get_promoted_objects()
+        if not promoted:
+            return
+
+        for i, (index, name) in enumerate(slots):
+            if name not in promoted:
+                continue
+
+            match = self._match_address_option(parts[index - 1])
+            if not match:
+                continue
+
+            start, direction = match
+            parts[index - 1] = parts[index - 1][:start]
+            choices[i] = [('-m set --match-set %s %s' % (ipset, direction),
+                           family == 4, family == 6)
+                          for family, ipset, _ in promoted[name]]
+
+    def _resolve_objects(self, slots, parts, choices=None):
+        """
+        Fill the object placeholders in parts with every combination of object
+        values. Yields the address families used by each combination.
+        """
+        if choices is None:
+            choices = [self._get_object_values(name) for _, name in slots]
+        for combination in product(*choices):
+            ipv4 = ipv6 = False
+            for (index, _), (value, value_ipv4, value_ipv6) in zip(slots, combination):
+                parts[index] = value
+                ipv4 = ipv4 or value_ipv4
+                ipv6 = ipv6 or value_ipv6
+            yield ipv4, ipv6
+
+    def _expand(self, template, ruletype='iptables', objects=True, zones=True):
+        parts = list(template.parts)
+        object_slots = template.objects if objects else []
+        zone_slots = template.zones if zones else []
+        zone_choices = [self._get_zone_interfaces(zone) for _, zone in zone_slots]
+        choices = [self._get_object_values(name) for _, name in object_slots]
+        if ruletype == 'iptables':
+            self._promote_objects(object_slots, parts, choices)
+
+        for ipv4, ipv6 in self._resolve_objects(object_slots, parts, choices):
+            tag = ''
+
+            # Restore the zone placeholders filled in by the previous combination
+            for index, _ in zone_slots:
+                parts[index] = template.parts[index]
+
+            # Only try to be smart if the rule is not already tagged as a IPv4 or IPv6 rule
+            if ruletype == 'iptables' and (ipv4 or ipv6):
+                if ipv4 and ipv6:
+                    continue
+
+                rule = ''.join(parts)
+                if ipv4:
+                    if self._is_ipv6_rule(rule):
+                        continue
+                    if not self._is_ipv4_rule(rule):
+                        tag = '-4 '
+                else:
+                    if self._is_ipv4_rule(rule):
+                        continue
+                    if not self._is_ipv6_rule(rule):
+                        tag = '-6 '
+
+            # Zones referenced from within object values are not part of the
+            # compiled template, so those rules must be compiled separately
+            if zones and any('%{' in parts[index] for index, _ in object_slots):
+                for rule in self._expand(RuleTemplate(''.join(parts)), objects=False):
+                    yield tag + rule
+                continue
+
+            for interfaces in product(*zone_choices):
+                for (index, _), interface in zip(zone_slots, interfaces):
+                    parts[index] = interface
+                yield tag + ''.join(parts)
+
+    def _expand_objects(self, string, ruletype='iptables'):
+        yield from self._expand(RuleTemplate(string), ruletype, zones=False)
 
     def _parse_rule(self, rule):
-        for rule_ in self._expand_objects(rule):
-            for rule_expanded in self._expand_zones(rule_):
-                yield rule_expanded
+        yield from self._expand(RuleTemplate(rule))
+
+    @staticmethod
+    def _compile_rules(rules):
+        """
+        Group the rules by table in a single pass while preserving the rule order
+        within each table. Rules for unknown tables are ignored.
+        """
+        tables = OrderedDict((table, []) for table in DEFAULT_CHAINS)
+        for table, rule in rules:
+            try:
+                tables[table].append(rule)
+            except KeyError:
+                pass
+        return tables
 
     def _output_rules(self, rules):
-        output = []
-        for table in DEFAULT_CHAINS:
-            output.append('*%s' % table)
-            for rule_table, rule in rules:
-                if rule_table == table:
-                    for rule_parsed in self._parse_rule(rule):
-                        output.append(rule_parsed)
-            output.append('COMMIT')
-        return output
+        optimize = self.config.get('optimize', {})
+        for table, table_rules in self._compile_rules(rules).items():
+            yield '*%s' % table
+            expanded = (i for rule in table_rules for i in self._parse_rule(rule))
+            if optimize.get('remove_duplicates') or optimize.get('shadowed_rules'):
+                expanded = self._optimize_rules(table, expanded)
+            yield from expanded
+            yield 'COMMIT'
+
+    def _get_rule_families(self, rule):
+        """ Returns the address families of a rule and the rule without the tag """
+        ipv4 = self._is_ipv4_rule(rule)
+        ipv6 = self._is_ipv6_rule(rule)
+        if ipv4 and not ipv6:
+            return {4}, self._remove_option(rule, '-4')
+        if ipv6 and not ipv4:
+            return {6}, self._remove_option(rule, '-6')
+        return {4, 6}, rule
+
+    @classmethod
+    def _split_target(cls, conditions):
+        """
+        Split the rule conditions into the matches and the -j/--jump target or
+        -g/--goto chain, if any
+        """
+        tokens = cls.token_pattern.finditer(conditions)
+        for token in tokens:
+            if token.group(0) in cls.jump_options:
+                target = next(tokens, None)
+                return (conditions[:token.start()],
+                        target.group(0) if target is not None else None)
+        return conditions, None
+
+    @classmethod
+    def _is_stateful(cls, matches):
+        """ Check if the matches include a stateful match module """
+        tokens = cls.token_pattern.findall(matches)
+        return any(option in cls.match_options and module in cls.stateful_matches
+                   for option, module in zip(tokens, tokens[1:]))
+
+    def _is_reorderable(self, rule):
+        """
+        Returns the target with its options, like '-j REJECT --reject-with
+        tcp-reset', of rules that can be freely reordered with other rules
+        with the same target and options, or None
+        """
+        conditions = self._get_rule_families(rule)[1].split(' ', 2)[2:]
+        conditions = conditions[0] if conditions else ''
+        matches, target = self._split_target(conditions)
+        if target not in self.terminal_targets:
+            return None
+        if self._is_stateful(matches):
+            return None
+        options = self.token_pattern.findall(conditions[len(matches):])[2:]
+        return ' '.join(['-j', target] + options)
+
+    def _optimize_rules(self, table, rules):
+        """
+        Remove rules that can never match, per chain and address family:
+
+        - Exact duplicates of an earlier rule with a terminal target, if nothing
+          between them can have modified the packet. Rules with stateful matches
+          are kept. Enabled by 'optimize.remove_duplicates'.
+        - Rules after an unconditional rule with a terminal target. Reported if
+          'optimize.shadowed_rules' is 'warn', removed if it is 'remove'.
+
+        The number of removed rules per chain is logged once per run.
+        """
+        optimize = self.config.get('optimize', {})
+        remove_duplicates = optimize.get('remove_duplicates', False)
+        shadowed_rules = optimize.get('shadowed_rules')
+        report = table not in self._optimize_reported
+        self._optimize_reported.add(table)
+
+        seen = {}
+        shadowed = {}
+        removed = OrderedDict()
+
+        for rule in rules:
+            families, untagged = self._get_rule_families(rule)
+            try:
+                command, chain, conditions = ('%s ' % untagged).split(' ', 2)
+            except ValueError:
+                command = None
+            if command != '-A':
+                yield rule
+                continue
+
+            conditions, target = self._split_target(conditions)
+            chain_seen = seen.setdefault(chain, {4: set(), 6: set()})
+            chain_shadowed = shadowed.setdefault(chain, set())
+
+            if families <= chain_shadowed and shadowed_rules:
+                if report:
+                    LOGGER.warning("Rule is shadowed by an earlier rule in %s/%s: %s",
+                                   table, chain, rule)
+                if shadowed_rules == 'remove':
+                    removed.setdefault(chain, [0, 0])[1] += 1
+                    continue
+                yield rule
+                continue
+
+            if target in self.terminal_targets:
+                stateful = self._is_stateful(conditions)
+                if remove_duplicates and not stateful:
+                    if all(untagged in chain_seen[i] for i in families):
+                        removed.setdefault(chain, [0, 0])[0] += 1
+                        continue
+                    for family in families:
+                        chain_seen[family].add(untagged)
+
+                if not self.comment_pattern.sub('', conditions).strip():
+                    chain_shadowed.update(families)
+            elif target and target not in self.passive_targets:
+                # The packet may have been modified, so earlier rules are no
+                # longer known to have matched the same packets
+                chain_seen[4].clear()
+                chain_seen[6].clear()
+
+            yield rule
+
+        if report:
+            for chain, (duplicates, shadowed_count) in removed.items():
+                LOGGER.info('Removed %d duplicate and %d shadowed rules from %s/%s',
+                            duplicates, shadowed_count, table, chain)
+
+    def _timed(self, stage, func, *args):
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.timings[stage] = time.monotonic() - start
+            LOGGER.debug("Stage '%s' finished in %.3f seconds", stage, self.timings[stage])
+
+    def _run_stages(self, stages):
+        """
+        Run independent (name, func, *args) stages and return their results in
+        order. In parallel mode all stages run concurrently and are allowed to
+        finish before the first error, if any, is raised. This ensures nothing is
+        still modifying the ruleset if a rollback is started.
+        """
+        if not self.parallel or len(stages) < 2:
+            return [self._timed(*stage) for stage in stages]
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+            futures = [executor.submit(self._timed, *stage) for stage in stages]
+
+        return [future.result() for future in futures]
 
     def save(self):
-        self.iptables.save(self.restore_file['ip'])
-        self.ip6tables.save(self.restore_file['ip6'])
-        self.ipsets.save(self.restore_file['ipset'])
+        self._run_stages([
+            ('iptables save', self.iptables.save, self.restore_file['ip']),
+            ('ip6tables save', self.ip6tables.save, self.restore_file['ip6']),
+            ('ipsets save', self.ipsets.save, self.restore_file['ipset'])
+        ])
+        self._save_state()
+
+    def _rulesets(self):
+        return OrderedDict([
+            ('iptables', (self.iptables, self.restore_file['ip'])),
+            ('ip6tables', (self.ip6tables, self.restore_file['ip6'])),
+            ('ipsets', (self.ipsets, self.restore_file['ipset']))
+        ])
+
+    def _load_state(self):
+        try:
+            with self.state_file.open('r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self):
+        """
+        Record the digests of the generated rulesets matching the saved ruleset.
+        If the saved ruleset was not generated by this run, e.g. when restoring
+        an archived ruleset, the state is no longer valid and is removed.
+        """
+        if self._generated_state is None:
+            try:
+                LOGGER.debug("Removing state file '%s'", self.state_file)
+                self.state_file.unlink()
+            except FileNotFoundError:
+                pass
+            return
+
+        state = self._generated_state
+        try:
+            self.state_file.parent.mkdir(parents=True)
+        except FileExistsError:
+            pass
+
+        tmp = self.state_file.parent / Path(str(self.state_file.name) + '.tmp')
+        LOGGER.debug("Writing state file '%s'", self.state_file)
+        with os.fdopen(os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(state, f, indent=4)
+        tmp.rename(self.state_file)
+
+    def _get_running(self, family):
+        return self._rulesets()[family][0].running()
+
+    def _is_saved_running(self, family):
+        """
+        Check if the running ruleset still matches the saved ruleset, to catch
+        changes done outside of fwgen since the last save.
+        """
+        ruleset, restore_file = self._rulesets()[family]
+        try:
+            with restore_file.open('r') as f:
+                saved = ruleset.digest(f)
+        except FileNotFoundError:
+            return False
+
+        return ruleset.digest(self._get_running(family)) == saved
 
     def archive(self):
         keep = self.config['archive']['keep']
         self._archive.create()
 
-        if keep < 1:
-            self._archive.clean(keep)
-            return
-
-        archive_file = self._archive.new()
-        archive_file.add(self.restore_file['ip'], self.restore_file['ip6'],
-                         self.restore_file['ipset'])
-        self._archive.clean(keep)
+        if keep > 0:
+            self._archive.add(self.restore_file['ip'], self.restore_file['ip6'],
+                              self.restore_file['ipset'])
+        self._archive.gc(keep)
 
     def restore_archived(self, name):
         archive_file = self._archive.get(name)
@@ -719,21 +2099,91 @@ class FwGen(object):
         self.ip6tables.restore(ip6tables)
         self.ipsets.restore(ipsets)
 
-    def _apply(self, ip_rules, ip6_rules, ipsets):
+    def _apply(self, ip_rules, ip6_rules, ipsets, skip=(), delta=None):
+        """
+        Apply the rulesets, except the families in skip. Delta maps iptables
+        families to --noflush payloads, which are applied instead of the full
+        ruleset. If 'ipsets' is in delta the ipsets are updated entry by entry.
+        """
+        delta = delta or {}
+
         # Apply ipsets first to ensure they exist when the rules are applied
-        try:
-            self.ipsets.apply(ipsets)
-        except RulesetError as e:
-            LOGGER.debug(str(e))
-            LOGGER.warning('The changes to the ipset configuration is not compatible with'
-                           ' atomic updating. The firewall will be temporary cleared!')
-            self.clear()
-            self.ipsets.apply(ipsets)
-
-        self.iptables.apply(ip_rules)
-        self.ip6tables.apply(ip6_rules)
-
-    def apply(self):
+        if 'ipsets' not in skip:
+            try:
+                self._timed('ipsets restore', self.ipsets.apply, ipsets, 'ipsets' in delta)
+            except RulesetError as e:
+                LOGGER.debug(str(e))
+                LOGGER.warning('The changes to the ipset configuration is not compatible with'
+                               ' atomic updating. The firewall will be temporary cleared!')
+                self.clear()
+                self._timed('ipsets restore', self.ipsets.apply, ipsets)
+                # Everything is cleared, so the full ruleset must be applied
+                skip = ()
+                delta = {}
+
+        stages = []
+        for family, ruleset, rules in [('iptables', self.iptables, ip_rules),
+                                       ('ip6tables', self.ip6tables, ip6_rules)]:
+            if family in skip:
+                continue
+            if delta.get(family) is not None:
+                stages.append(('%s restore' % family, ruleset.apply, delta[family], True))
+            else:
+                stages.append(('%s restore' % family, ruleset.apply, rules))
+        self._run_stages(stages)
+
+    def _family_rules(self, rules, family):
+        """
+        Filter the rules for an address family. Rules tagged with -4 or -6 are
+        only included for that family, with the tag removed.
+        """
+        for rule in rules:
+            family_rule = self._family_rule(rule, family)
+            if family_rule is not None:
+                yield family_rule
+
+    def _family_rule(self, rule, family):
+        """ The rule for an address family, or None if not included """
+        option = '-%d' % family
+        other = '-6' if family == 4 else '-4'
+        tagged = self._has_option(rule, option)
+        tagged_other = self._has_option(rule, other)
+
+        if tagged and not tagged_other:
+            return self._remove_option(rule, option)
+        if not tagged_other or tagged:
+            return rule
+        return None
+
+    def _spool_rulesets(self, rules):
+        """
+        Expand the rules once, writing the iptables, ip6tables and ipsets
+        rulesets to temporary files in a single pass. Each iteration re-reads
+        the file, so the rulesets are neither regenerated nor held in memory.
+        The files are removed when the returned rulesets are garbage collected.
+        """
+        import tempfile
+
+        files = [tempfile.NamedTemporaryFile('w', prefix='fwgen-') for _ in range(3)]
+        ip, ip6, ipset = files
+        for rule in self._output_rules(rules):
+            for family, f in [(4, ip), (6, ip6)]:
+                family_rule = self._family_rule(rule, family)
+                if family_rule is not None:
+                    f.write('%s\n' % family_rule)
+        for rule in self._output_ipsets():
+            ipset.write('%s\n' % rule)
+
+        for f in files:
+            f.flush()
+        return tuple(LazyRules(lambda f=f: self._read_spooled(f)) for f in files)
+
+    @staticmethod
+    def _read_spooled(f):
+        # Holds a reference to the temporary file until fully read
+        yield from Ruleset._get_restore_rules(Path(f.name))
+
+    def _get_all_rules(self):
         rules = []
         rules.extend(self._get_policy_rules())
         rules.extend(self._get_helper_chains())
@@ -741,9 +2191,223 @@ class FwGen(object):
         rules.extend(self._get_rules(self.config.get('default', {})))
         rules.extend(self._get_rules(self.config.get('pre_zone', {})))
         rules.extend(self._get_zone_rules())
-        iptables_rules = self._output_rules(rules)
-        LOGGER.debug('\n'.join(iptables_rules))
-        self._apply(iptables_rules, iptables_rules, self._output_ipsets())
+        return rules
+
+    def _cache_key(self):
+        """
+        The cache key covers everything the generated rulesets depend on: the
+        fwgen version, the merged config, the runtime config overlay and the
+        modification time and size of any ipset entries files
+        """
+        key = hashlib.sha256()
+        for part in [__version__, self.cache_salt or '',
+                     json.dumps(self.config, default=json_default),
+                     json.dumps(self._get_entries_files_state())]:
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return key.hexdigest()
+
+    def generate(self):
+        """
+        Returns the iptables, ip6tables and ipsets rulesets. The rules are
+        generated once and read back from a file on each iteration instead of
+        being kept in memory.
+        """
+        if self.cache:
+            key = self._cache_key()
+            cached = self.cache.get(key)
+            if cached:
+                return cached
+
+        ip_rules, ip6_rules, ipsets = self._spool_rulesets(self._get_all_rules())
+
+        if self.cache:
+            try:
+                self.cache.add(key, ip_rules, ip6_rules, ipsets)
+                return self.cache.get(key)
+            except OSError as e:
+                LOGGER.debug('Unable to cache the generated ruleset: %s', e)
+
+        return ip_rules, ip6_rules, ipsets
+
+    def apply(self, force=False, delta=False):
+        """
+        Apply the generated ruleset. Unless forced, any family where both the
+        generated and running ruleset are unchanged since the last save is skipped.
+        In delta mode only the changed iptables and ip6tables chains and the
+        changed ipset entries are updated.
+        """
+        ip_rules, ip6_rules, ipsets = self.generate()
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('\n'.join(ip_rules))
+            LOGGER.debug('\n'.join(ip6_rules))
+
+        generated = OrderedDict([
+            ('iptables', ip_rules),
+            ('ip6tables', ip6_rules),
+            ('ipsets', ipsets)
+        ])
+        self._generated_state = OrderedDict()
+        for family, rules in generated.items():
+            self._generated_state[family] = self._rulesets()[family][0].summary(rules)
+        LOGGER.debug('Address family index: %(values)d values, %(hits)d hits, '
+                     '%(misses)d misses', self.family_index.stats())
+
+        self.skipped = []
+        delta_rules = {}
+        if not force:
+            state = self._load_state()
+            for family, new in self._generated_state.items():
+                old = state.get(family, {})
+                if old.get('digest') == new['digest'] and self._is_saved_running(family):
+                    self.skipped.append(family)
+                elif delta and family == 'ipsets':
+                    delta_rules[family] = None
+                elif delta and 'chains' in old and self._is_saved_running(family):
+                    rules = self._rulesets()[family][0].delta(generated[family],
+                                                             old['chains'], new['chains'])
+                    if rules is None:
+                        LOGGER.info('The %s chains or chain references have changed. '
+                                    'Falling back to a full restore.', family)
+                    else:
+                        delta_rules[family] = rules
+
+        self._apply(ip_rules, ip6_rules, ipsets, self.skipped, delta_rules)
+
+    def _get_rule_sources(self, family):
+        """
+        Returns the generated rules of an address family by (table, chain), as
+        a list of (config rule, generated rule) tuples
+        """
+        rules = self._get_all_rules()
+        candidates = {}
+        for table, table_rules in self._compile_rules(rules).items():
+            candidates[table] = [(rule, expanded) for rule in table_rules
+                                 for expanded in self._family_rules(self._parse_rule(rule),
+                                                                    family)]
+
+        sources = OrderedDict()
+        table = None
+        position = 0
+        for rule in self._family_rules(self._output_rules(rules), family):
+            if rule.startswith('*'):
+                table = rule[1:]
+                position = 0
+            elif rule.startswith('-A '):
+                # Skip any rules removed by the optimizer
+                table_candidates = candidates.get(table, [])
+                found = position
+                while found < len(table_candidates) and table_candidates[found][1] != rule:
+                    found += 1
+                if found < len(table_candidates):
+                    source = table_candidates[found][0]
+                    position = found + 1
+                else:
+                    # Not generated from a config rule as is, so it is kept
+                    # as a source of its own
+                    LOGGER.debug("Unable to find the config rule of '%s' in table '%s'",
+                                 rule, table)
+                    source = rule
+                sources.setdefault((table, rule.split(maxsplit=2)[1]), []).append((source, rule))
+        return sources
+
+    def _analyze_chain(self, table, chain, rules, counters):
+        """
+        Estimate the rules traversed per packet in a chain, before and after
+        sorting runs of config rules with the same terminal target by hits.
+        Only packets getting a verdict in the chain, by a terminal target or
+        the policy, are counted.
+        """
+        if counters is None or len(counters['rules']) != len(rules):
+            raise RulesetError("The running ruleset does not match the generated ruleset "
+                               "in chain '%s' of table '%s'. Apply the ruleset before "
+                               "analyzing it." % (chain, table))
+
+        # Group the generated rules by the config rule they were expanded from
+        blocks = []
+        for (source, rule), hits in zip(rules, counters['rules']):
+            target = self._is_reorderable(rule)
+            if blocks and blocks[-1]['source'] == source:
+                blocks[-1]['hits'].append(hits)
+                if blocks[-1]['target'] != target:
+                    blocks[-1]['target'] = None
+            else:
+                blocks.append({'source': source, 'hits': [hits], 'target': target})
+            blocks[-1].setdefault('terminal', []).append(
+                self._split_target(rule)[1] in self.terminal_targets)
+
+        def cost(blocks):
+            position = 0
+            total = 0
+            packets = 0
+            for block in blocks:
+                for hits, terminal in zip(block['hits'], block['terminal']):
+                    position += 1
+                    if terminal:
+                        total += hits * position
+                        packets += hits
+            if counters['policy'] is not None:
+                total += counters['policy'] * position
+                packets += counters['policy']
+            return total, packets
+
+        reordered = []
+        run = []
+        for block in blocks + [{'target': None}]:
+            if run and block['target'] == run[0]['target']:
+                run.append(block)
+                continue
+            reordered.extend(sorted(run, key=lambda i: -sum(i['hits']) / len(i['hits'])))
+            run = [block] if block['target'] else []
+            if not block['target'] and 'source' in block:
+                reordered.append(block)
+
+        before, packets = cost(blocks)
+        after, _ = cost(reordered)
+        order = None
+        if reordered != blocks:
+            order = [(i['source'], sum(i['hits'])) for i in reordered]
+
+        return {
+            'table': table,
+            'chain': chain,
+            'packets': packets,
+            'before': before,
+            'after': after,
+            'order': order
+        }
+
+    def analyze(self, interval=60):
+        """
+        Collect the packet counters of the running iptables and ip6tables
+        rulesets over the interval, or since they were reset if the interval is
+        0. Returns a report for each chain that has seen packets, with the
+        total rules traversed before and after the suggested reordering.
+        """
+        rulesets = [('iptables', self.iptables, 4), ('ip6tables', self.ip6tables, 6)]
+        counters = {name: ruleset.counters() for name, ruleset, _ in rulesets}
+        if interval:
+            time.sleep(interval)
+            for name, ruleset, _ in rulesets:
+                start = counters[name]
+                counters[name] = ruleset.counters()
+                for key, summary in counters[name].items():
+                    if key not in start:
+                        continue
+                    if summary['policy'] is not None:
+                        summary['policy'] -= start[key]['policy'] or 0
+                    summary['rules'] = [i - j for i, j in zip(summary['rules'],
+                                                              start[key]['rules'])]
+
+        report = OrderedDict()
+        for name, _, family in rulesets:
+            report[name] = []
+            for (table, chain), rules in self._get_rule_sources(family).items():
+                chain_report = self._analyze_chain(table, chain, rules,
+                                                   counters[name].get((table, chain)))
+                if chain_report['packets']:
+                    report[name].append(chain_report)
+        return report
 
     def clear(self):
         # Clear ipsets after the iptables rules to ensure ipsets are not in use
@@ -788,16 +2452,25 @@ class FwGen(object):
 
 
 class Rollback(FwGen):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, **kwargs):
+        super().__init__(config, **kwargs)
         self.ip_rollback = None
         self.ip6_rollback = None
         self.ipsets_rollback = None
 
+    def _get_running(self, family):
+        return {
+            'iptables': self.ip_rollback,
+            'ip6tables': self.ip6_rollback,
+            'ipsets': self.ipsets_rollback
+        }[family]
+
     def __enter__(self):
-        self.ip_rollback = self.iptables.running()
-        self.ip6_rollback = self.ip6tables.running()
-        self.ipsets_rollback = self.ipsets.running()
+        self.ip_rollback, self.ip6_rollback, self.ipsets_rollback = self._run_stages([
+            ('iptables running', self.iptables.running),
+            ('ip6tables running', self.ip6tables.running),
+            ('ipsets running', self.ipsets.running)
+        ])
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -1,11 +1,14 @@
+import os
 import subprocess
 import logging
+import hashlib
+import pickle
 from collections import OrderedDict
+from collections.abc import Mapping
+from pathlib import Path
 import string
 import random
 
-import yaml
-
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,11 +23,93 @@ def ordered_dict_merge(d1, d2):
             d2[k] = v
     return d2
 
+def _is_mergeable(value):
+    if isinstance(value, LayeredDict):
+        return value.mergeable
+    return isinstance(value, OrderedDict)
+
+class LayeredDict(Mapping):
+    """
+    Read-only view of config layers, ordered from lowest to highest priority.
+    Values are resolved on access with the same result as merging the layers
+    in order with ordered_dict_merge, but without copying or walking subtrees
+    that are never accessed. The layers must not be modified afterwards.
+    """
+    def __init__(self, *layers):
+        self.layers = layers
+        self.mergeable = _is_mergeable(layers[0])
+        self._values = {}
+        self._keys = None
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        # Collect the values from the top down until one replaces the rest
+        values = []
+        for layer in reversed(self.layers):
+            if key not in layer:
+                continue
+            value = layer[key]
+            if values and not isinstance(value, Mapping):
+                break
+            values.append(value)
+            if not _is_mergeable(value):
+                break
+
+        if not values:
+            raise KeyError(key)
+
+        if len(values) == 1:
+            value = values[0]
+        else:
+            value = LayeredDict(*reversed(values))
+
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        if self._keys is None:
+            keys = OrderedDict()
+            for layer in self.layers:
+                for key in layer:
+                    keys[key] = None
+            self._keys = list(keys)
+        return iter(self._keys)
+
+    def __len__(self):
+        if self._keys is None:
+            iter(self)
+        return len(self._keys)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.layers)
+
+def json_default(obj):
+    """ json.dumps() default function that serializes LayeredDicts in order """
+    if isinstance(obj, Mapping):
+        return OrderedDict(obj.items())
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
 def random_word(length=3):
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(length))
 
-def yaml_load_ordered(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+_ORDERED_LOADERS = {}
+
+def _ordered_loader(Loader, object_pairs_hook):
+    try:
+        return _ORDERED_LOADERS[(Loader, object_pairs_hook)]
+    except KeyError:
+        pass
+
+    import yaml
+
     class OrderedLoader(Loader):
         pass
 
@@ -36,7 +121,142 @@ def yaml_load_ordered(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict)
         yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
         construct_mapping)
 
-    return yaml.load(stream, OrderedLoader)
+    _ORDERED_LOADERS[(Loader, object_pairs_hook)] = OrderedLoader
+    return OrderedLoader
+
+def yaml_load_ordered(stream, Loader=None, object_pairs_hook=OrderedDict):
+    # yaml is imported here as it is not needed when the config is cached
+    import yaml
+
+    if Loader is None:
+        # Use the libyaml based loader if PyYAML is built with it
+        Loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+    return yaml.load(stream, _ordered_loader(Loader, object_pairs_hook))
+
+def yaml_load_file(path, cache_dir=None):
+    """
+    Load a YAML file with ordered mappings. If cache_dir is given the parsed
+    content is pickled there and reused for as long as the mtime and size of
+    the file are unchanged.
+    """
+    path = Path(path)
+    if cache_dir is None:
+        with path.open('r') as f:
+            return yaml_load_ordered(f)
+
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    cache_file = Path(cache_dir) / hashlib.sha256(
+        str(path.resolve()).encode('utf-8')).hexdigest()
+
+    try:
+        with cache_file.open('rb') as f:
+            # Only trust cache files written by ourselves
+            if os.fstat(f.fileno()).st_uid == os.getuid() and pickle.load(f) == key:
+                LOGGER.debug("Using cached config '%s' for '%s'", cache_file, path)
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        LOGGER.debug("Ignoring invalid config cache '%s': %s", cache_file, e)
+
+    with path.open('r') as f:
+        data = yaml_load_ordered(f)
+
+    tmp = cache_file.with_name('%s.%d.tmp' % (cache_file.name, os.getpid()))
+    try:
+        try:
+            Path(cache_dir).mkdir(mode=0o700, parents=True)
+        except FileExistsError:
+            pass
+        with os.fdopen(os.open(str(tmp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                       'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        tmp.replace(cache_file)
+    except OSError as e:
+        LOGGER.debug("Unable to cache config '%s': %s", path, e)
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+    return data
+
+def _parse_network(network):
+    """
+    Returns the address family, address bits and the first and last address of
+    a network, address or address range as integers
+    """
+    import socket
+
+    family, bits = (socket.AF_INET6, 128) if ':' in network else (socket.AF_INET, 32)
+    if '-' in network:
+        first, last = network.split('-', 1)
+        start = int.from_bytes(socket.inet_pton(family, first), 'big')
+        end = int.from_bytes(socket.inet_pton(family, last), 'big')
+        if start > end:
+            raise ValueError('Invalid range %s' % network)
+    else:
+        address, _, prefixlen = network.partition('/')
+        prefixlen = int(prefixlen) if prefixlen else bits
+        if not 0 <= prefixlen <= bits:
+            raise ValueError('Invalid prefix length in %s' % network)
+        hostmask = (1 << (bits - prefixlen)) - 1
+        start = int.from_bytes(socket.inet_pton(family, address), 'big') & ~hostmask
+        end = start | hostmask
+    return family, bits, start, end
+
+def _range_to_networks(family, bits, start, end):
+    import socket
+
+    while start <= end:
+        # The largest aligned block starting at start that fits in the range. A
+        # zero prefix length is not accepted by ipset, so the largest block is
+        # half of the address space.
+        size = min(start & -start or 1 << (bits - 1), 1 << (bits - 1))
+        while size > end - start + 1:
+            size >>= 1
+        prefixlen = bits - size.bit_length() + 1
+        address = socket.inet_ntop(family, start.to_bytes(bits // 8, 'big'))
+        yield address if prefixlen == bits else '%s/%d' % (address, prefixlen)
+        start += size
+
+def aggregate_networks(networks):
+    """
+    Collapse IPv4 and IPv6 networks, addresses and address ranges into the
+    minimal list of networks covering the same addresses, IPv4 first. Each
+    range is kept as a single integer with the first address in the high bits,
+    so sorting them also sorts by address. Entries that can not be parsed,
+    like ones with options, are returned unchanged at the end.
+    """
+    ranges = {}
+    others = []
+    for network in networks:
+        try:
+            family, bits, start, end = _parse_network(network)
+        except (OSError, ValueError):
+            others.append(network)
+            continue
+        ranges.setdefault((family, bits), []).append(start << bits | end)
+
+    for (family, bits), keys in sorted(ranges.items(), key=lambda i: i[0][1]):
+        keys.sort()
+        mask = (1 << bits) - 1
+        cur_start = cur_end = None
+        for key in keys:
+            start, end = key >> bits, key & mask
+            if cur_end is not None and start <= cur_end + 1:
+                cur_end = max(cur_end, end)
+                continue
+            if cur_end is not None:
+                yield from _range_to_networks(family, bits, cur_start, cur_end)
+            cur_start, cur_end = start, end
+        if cur_end is not None:
+            yield from _range_to_networks(family, bits, cur_start, cur_end)
+
+    yield from others
 
 def run_command(cmd):
     LOGGER.debug("Running command: '%s'", ' '.join(cmd))
@@ -0,0 +1,72 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+
+# Modules that are only needed by specific subcommands, and must not be
+# imported by the others to keep the CLI startup fast
+HEAVY_MODULES = {'fwgen.fwgen', 'yaml', 'tarfile', 'difflib', 'concurrent.futures'}
+ALLOWED = {
+    'version': set(),
+    'show config': {'yaml'},
+    'show running': {'yaml', 'fwgen.fwgen'},
+    'show generated': {'yaml', 'fwgen.fwgen'},
+    'show archive': {'yaml', 'fwgen.fwgen'},
+    'apply': {'yaml', 'fwgen.fwgen', 'difflib'},
+}
+
+
+def imported_modules(*args):
+    """ Run the CLI with -X importtime and return the names of the imported modules """
+    code = ('import sys; sys.argv = ["fwgen"] + sys.argv[1:]; '
+            'from fwgen.bin.fwgen import main; main()')
+    p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code] + list(args),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    _, stderr = p.communicate()
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+@pytest.fixture
+def cli_args(tmpdir):
+    config = {
+        'cmds': {
+            'iptables_save': 'true',
+            'iptables_restore': 'true',
+            'ip6tables_save': 'true',
+            'ip6tables_restore': 'true',
+            'ipset': 'true',
+        },
+        'restore_files': {
+            'iptables': str(tmpdir.join('iptables.restore')),
+            'ip6tables': str(tmpdir.join('ip6tables.restore')),
+            'ipsets': str(tmpdir.join('ipsets.restore')),
+        },
+        'state_file': str(tmpdir.join('state.json')),
+        'cache': {'path': str(tmpdir.join('cache'))},
+        'archive': {'path': str(tmpdir.join('archive'))},
+    }
+    return ['--config', str(tmpdir.join('missing.yml')), '--config-json', json.dumps(config)]
+
+
+# -X importtime was added in Python 3.7
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='requires -X importtime')
+@pytest.mark.parametrize('subcommand', sorted(ALLOWED))
+def test_imported_modules(subcommand, cli_args):
+    if subcommand == 'version':
+        args = ['--version']
+    elif subcommand == 'apply':
+        args = cli_args + ['apply', '--no-confirm', '--no-save', '--no-diff']
+    else:
+        args = cli_args + subcommand.split()
+
+    modules = imported_modules(*args)
+    assert 'fwgen.bin.fwgen' in modules
+    assert modules & HEAVY_MODULES <= ALLOWED[subcommand]
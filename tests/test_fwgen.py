@@ -1,6 +1,12 @@
+import os
+import json
+import time
 from collections import OrderedDict
+from pathlib import Path
 
-from fwgen import fwgen
+import pytest
+
+from fwgen import fwgen, helpers
 
 
 class OrderedDefaultDict(OrderedDict):
@@ -481,4 +487,993 @@ class TestFwGen(object):
             '*security',
             'COMMIT'
         ]
-        assert fw._output_rules(rules) == output
+        assert list(fw._output_rules(rules)) == output
+
+    def test_output_rules_interleaved_tables(self):
+        rules = [
+            ('nat', '-A POSTROUTING -j MASQUERADE'),
+            ('filter', '-A INPUT -j ACCEPT'),
+            ('invalid', '-A INPUT -j DROP'),
+            ('nat', '-A PREROUTING -j ACCEPT'),
+            ('filter', '-A OUTPUT -j ACCEPT')
+        ]
+        fw = fwgen.FwGen({})
+        output = [
+            '*filter',
+            '-A INPUT -j ACCEPT',
+            '-A OUTPUT -j ACCEPT',
+            'COMMIT',
+            '*nat',
+            '-A POSTROUTING -j MASQUERADE',
+            '-A PREROUTING -j ACCEPT',
+            'COMMIT',
+            '*mangle',
+            'COMMIT',
+            '*raw',
+            'COMMIT',
+            '*security',
+            'COMMIT'
+        ]
+        assert list(fw._output_rules(rules)) == output
+
+    def test_nested_object_expansion(self):
+        config = {
+            'objects': {
+                'hosts': ['10.0.0.1', 'fd32::1'],
+                'all': ['${hosts}', '192.168.0.1']
+            }
+        }
+        fw = fwgen.FwGen(config)
+        rule = '-A INPUT -s ${all} -j ACCEPT'
+        rules_expanded = [
+            '-4 -A INPUT -s 10.0.0.1 -j ACCEPT',
+            '-6 -A INPUT -s fd32::1 -j ACCEPT',
+            '-4 -A INPUT -s 192.168.0.1 -j ACCEPT'
+        ]
+
+        result = list(fw._expand_objects(rule))
+        assert result == rules_expanded
+
+    def test_ipset_object_expansion_not_tagged(self):
+        config = {
+            'objects': {
+                'net': '10.0.0.0/24',
+                'port': 80
+            }
+        }
+        fw = fwgen.FwGen(config)
+        entry = 'add web ${net},tcp:${port}'
+        entries_expanded = ['add web 10.0.0.0/24,tcp:80']
+
+        result = list(fw._expand_objects(entry, ruletype='ipset'))
+        assert result == entries_expanded
+
+    def test_parse_rule_objects_before_zones(self):
+        config = {
+            'objects': {
+                'hosts': ['10.0.0.1', '10.0.0.2']
+            },
+            'zones': {
+                'lan': {
+                    'interfaces': ['eth0', 'eth1']
+                }
+            }
+        }
+        fw = fwgen.FwGen(config)
+        rule = '-A FORWARD -i %{lan} -s ${hosts} -j ACCEPT'
+        rules_expanded = [
+            '-4 -A FORWARD -i eth0 -s 10.0.0.1 -j ACCEPT',
+            '-4 -A FORWARD -i eth1 -s 10.0.0.1 -j ACCEPT',
+            '-4 -A FORWARD -i eth0 -s 10.0.0.2 -j ACCEPT',
+            '-4 -A FORWARD -i eth1 -s 10.0.0.2 -j ACCEPT'
+        ]
+
+        result = list(fw._parse_rule(rule))
+        assert result == rules_expanded
+
+    def test_parse_rule_object_with_zone(self):
+        config = {
+            'objects': {
+                'ifs': ['eth9', '%{lan}']
+            },
+            'zones': {
+                'lan': {
+                    'interfaces': ['eth0', 'eth1']
+                }
+            }
+        }
+        fw = fwgen.FwGen(config)
+        rule = '-A FORWARD -i %{lan} -o ${ifs} -j ACCEPT'
+        rules_expanded = [
+            '-A FORWARD -i eth0 -o eth9 -j ACCEPT',
+            '-A FORWARD -i eth1 -o eth9 -j ACCEPT',
+            '-A FORWARD -i eth0 -o eth0 -j ACCEPT',
+            '-A FORWARD -i eth0 -o eth1 -j ACCEPT',
+            '-A FORWARD -i eth1 -o eth0 -j ACCEPT',
+            '-A FORWARD -i eth1 -o eth1 -j ACCEPT'
+        ]
+
+        result = list(fw._parse_rule(rule))
+        assert result == rules_expanded
+
+    def test_family_index(self):
+        config = {
+            'objects': {
+                'hosts': ['10.0.0.1', 'fd32::1', 'tcp'],
+                'nested': '${hosts}'
+            }
+        }
+        fw = fwgen.FwGen(config)
+        assert fw.family_index.stats() == {'values': 3, 'hits': 0, 'misses': 0}
+
+        rule = '-A INPUT -p ${hosts} -s ${nested} -j ACCEPT'
+        list(fw._expand_objects(rule))
+        list(fw._expand_objects(rule))
+        assert fw.family_index.stats() == {'values': 3, 'hits': 3, 'misses': 0}
+        assert fw.family_index.lookup('192.168.0.0/24') == 4
+        assert fw.family_index.lookup('fd33::/64') == 6
+        assert fw.family_index.lookup('eth0') is None
+        assert fw.family_index.misses == 3
+
+    def test_family_rules(self):
+        rules = [
+            '*filter',
+            ':INPUT DROP',
+            '-4 -A INPUT -s 10.0.0.1 -j ACCEPT',
+            '-A INPUT -6 -s fd32::1 -j ACCEPT',
+            '-A INPUT -i lo -j ACCEPT',
+            'COMMIT'
+        ]
+        fw = fwgen.FwGen({})
+        assert list(fw._family_rules(rules, 4)) == [
+            '*filter',
+            ':INPUT DROP',
+            '-A INPUT -s 10.0.0.1 -j ACCEPT',
+            '-A INPUT -i lo -j ACCEPT',
+            'COMMIT'
+        ]
+        assert list(fw._family_rules(rules, 6)) == [
+            '*filter',
+            ':INPUT DROP',
+            '-A INPUT -s fd32::1 -j ACCEPT',
+            '-A INPUT -i lo -j ACCEPT',
+            'COMMIT'
+        ]
+
+    def test_run_stages_parallel(self):
+        fw = fwgen.FwGen({}, parallel=True)
+        finished = []
+
+        def stage(name, delay):
+            time.sleep(delay)
+            finished.append(name)
+            return name
+
+        results = fw._run_stages([
+            ('first', stage, 'first', 0.05),
+            ('second', stage, 'second', 0)
+        ])
+        assert results == ['first', 'second']
+        assert finished == ['second', 'first']
+        assert list(sorted(fw.timings)) == ['first', 'second']
+
+    def test_run_stages_parallel_error(self):
+        fw = fwgen.FwGen({}, parallel=True)
+        finished = []
+
+        def fail():
+            raise fwgen.RulesetError('failed')
+
+        def stage():
+            time.sleep(0.05)
+            finished.append(True)
+
+        with pytest.raises(fwgen.RulesetError):
+            fw._run_stages([
+                ('fail', fail),
+                ('stage', stage)
+            ])
+        assert finished == [True]
+
+    def test_saved_running(self, tmpdir):
+        restore_file = tmpdir.join('iptables.restore')
+        restore_file.write('# Generated by iptables-save\n*filter\n:INPUT DROP [1:2]\nCOMMIT\n')
+        config = OrderedDefaultDict()
+        config['restore_files']['iptables'] = str(restore_file)
+        config['restore_files']['ipsets'] = str(tmpdir.join('ipsets.restore'))
+        fw = fwgen.FwGen(config)
+
+        fw._get_running = lambda family: ['*filter', ':INPUT DROP [5:10]', 'COMMIT']
+        assert fw._is_saved_running('iptables')
+        assert not fw._is_saved_running('ipsets')
+
+        fw._get_running = lambda family: ['*filter', ':INPUT ACCEPT [5:10]', 'COMMIT']
+        assert not fw._is_saved_running('iptables')
+
+    def test_iptables_delta(self):
+        old_rules = [
+            '*filter',
+            ':INPUT DROP',
+            ':zone0_INPUT -',
+            ':zone1_INPUT -',
+            '-A INPUT -i eth0 -j zone0_INPUT',
+            '-A INPUT -i eth1 -j zone1_INPUT',
+            '-A zone0_INPUT -p tcp --dport 22 -j ACCEPT',
+            '-A zone1_INPUT -p tcp --dport 80 -j ACCEPT',
+            'COMMIT',
+            '*nat',
+            ':POSTROUTING ACCEPT',
+            '-A POSTROUTING -o eth1 -j MASQUERADE',
+            'COMMIT'
+        ]
+        new_rules = list(old_rules)
+        new_rules[7] = '-A zone1_INPUT -p tcp --dport 443 -j ACCEPT'
+        old = fwgen.IptablesCommon.chains(old_rules)
+        new = fwgen.IptablesCommon.chains(new_rules)
+        assert fwgen.IptablesCommon.delta(new_rules, old, new) == [
+            '*filter',
+            '-F zone1_INPUT',
+            '-A zone1_INPUT -p tcp --dport 443 -j ACCEPT',
+            'COMMIT'
+        ]
+        assert fwgen.IptablesCommon.delta(old_rules, old, old) == []
+
+    def test_iptables_delta_changed_references(self):
+        old_rules = [
+            '*filter',
+            ':INPUT DROP',
+            ':zone0_INPUT -',
+            '-A INPUT -i eth0 -j zone0_INPUT',
+            'COMMIT'
+        ]
+        new_rules = [
+            '*filter',
+            ':INPUT DROP',
+            ':zone0_INPUT -',
+            '-A INPUT -i eth0 -j ACCEPT',
+            'COMMIT'
+        ]
+        added_chain = old_rules[:3] + [':zone1_INPUT -'] + old_rules[3:]
+        old = fwgen.IptablesCommon.chains(old_rules)
+        assert fwgen.IptablesCommon.delta(
+            new_rules, old, fwgen.IptablesCommon.chains(new_rules)) is None
+        assert fwgen.IptablesCommon.delta(
+            added_chain, old, fwgen.IptablesCommon.chains(added_chain)) is None
+
+    def test_ipset_delta(self):
+        ipsets = fwgen.Ipsets()
+        ipsets.running = lambda: [
+            'create blocked hash:net family inet hashsize 1024 maxelem 65536',
+            'add blocked 10.0.0.0/8',
+            'add blocked 192.168.0.0/16',
+            'create hosts hash:ip family inet hashsize 1024 maxelem 65536 counters',
+            'add hosts 10.0.0.1 packets 10 bytes 800',
+            'create old hash:ip family inet hashsize 1024 maxelem 65536',
+        ]
+        rules = [
+            'create blocked hash:net',
+            'add blocked 10.0.0.0/8',
+            'add blocked 172.16.0.0/12',
+            'create hosts hash:ip counters',
+            'add hosts 10.0.0.1',
+            'create new hash:ip',
+            'add new 10.0.0.2'
+        ]
+        assert ipsets._delta(rules) == [
+            'del blocked 192.168.0.0/16',
+            'add blocked 172.16.0.0/12',
+            'create new hash:ip',
+            'add new 10.0.0.2',
+            'flush old',
+            'destroy old'
+        ]
+
+    def test_ipset_delta_incompatible(self):
+        ipsets = fwgen.Ipsets()
+        ipsets.running = lambda: [
+            'create blocked hash:net family inet hashsize 1024 maxelem 65536',
+            'add blocked 10.0.0.0/8'
+        ]
+        ipsets._get_ipset_tmp_name = lambda ipset: '%s.tmp' % ipset
+        rules = [
+            'create blocked hash:net family inet6',
+            'add blocked fd00::/8'
+        ]
+        assert ipsets._delta(rules) == [
+            'create blocked.tmp hash:net family inet6',
+            'add blocked.tmp fd00::/8',
+            'swap blocked.tmp blocked',
+            'destroy blocked.tmp'
+        ]
+        assert not ipsets._is_compatible('hash:net', 'hash:net family inet timeout 300')
+        assert not ipsets._is_compatible('hash:ip', 'hash:net family inet')
+        assert ipsets._is_compatible('hash:net maxelem 65536',
+                                     'hash:net family inet hashsize 1024 maxelem 65536')
+        # Automatic sizing only needs the running set to be large enough
+        assert ipsets._is_compatible('hash:net hashsize 4096 maxelem 8192',
+                                     'hash:net family inet hashsize 1024 maxelem 65536')
+        assert not ipsets._is_compatible('hash:net maxelem 131072',
+                                         'hash:net family inet hashsize 1024 maxelem 65536')
+
+    def test_ipset_replace(self):
+        ipsets = fwgen.Ipsets()
+        ipsets.list = lambda: ['a', 'old']
+        ipsets._get_ipset_tmp_name = lambda ipset: '%s.tmp' % ipset
+        rules = [
+            'create a hash:ip',
+            'flush a',
+            'add a 10.0.0.1',
+            'create b hash:ip',
+            'add b 10.0.0.2'
+        ]
+        assert list(ipsets._replace(rules)) == [
+            'create a.tmp hash:ip',
+            'flush a.tmp',
+            'add a.tmp 10.0.0.1',
+            'create b hash:ip',
+            'add b 10.0.0.2',
+            'swap a.tmp a',
+            'destroy a.tmp',
+            'flush old',
+            'destroy old'
+        ]
+        assert ipsets._parse(rules + ['destroy b', 'add b']) == OrderedDict([
+            ('a', ('hash:ip', ['10.0.0.1'])),
+            ('b', ('hash:ip', ['10.0.0.2']))
+        ])
+
+    def test_ruleset_apply_streaming(self, tmpdir):
+        output = tmpdir.join('output')
+        ruleset = fwgen.Ruleset()
+        ruleset.chunk_size = 10
+        ruleset.restore_cmd = ['sh', '-c', 'cat > %s' % output]
+        ruleset.apply('rule %d' % i for i in range(100))
+        assert output.read() == ''.join('rule %d\n' % i for i in range(100))
+
+    def test_ruleset_apply_error(self):
+        ruleset = fwgen.Ruleset()
+        ruleset.restore_cmd = ['sh', '-c', 'echo invalid rule >&2; exit 1']
+        with pytest.raises(fwgen.RulesetError) as e:
+            ruleset.apply('rule %d' % i for i in range(100000))
+        assert str(e.value) == 'invalid rule\n'
+
+    def test_ruleset_apply_generator_error(self, tmpdir):
+        output = tmpdir.join('output')
+        ruleset = fwgen.Ruleset()
+        ruleset.restore_cmd = ['sh', '-c', 'cat > %s; touch %s.done' % (output, output)]
+
+        def rules():
+            yield '*filter'
+            raise KeyError('missing')
+
+        with pytest.raises(KeyError):
+            ruleset.apply(rules())
+        assert not tmpdir.join('output.done').exists()
+
+    def test_generate_cache(self, tmpdir):
+        config = OrderedDefaultDict()
+        config['cache']['path'] = str(tmpdir.join('cache'))
+        config['default']['filter']['INPUT'] = ['-p tcp --dport 22 -j ACCEPT']
+        fw = fwgen.FwGen(config, cache=True)
+        generated = [list(i) for i in fw.generate()]
+        assert [list(i) for i in fw.generate()] == generated
+        assert len(tmpdir.join('cache').listdir()) == 1
+
+        # A stale entry is used as long as the key matches
+        entry = tmpdir.join('cache').listdir()[0]
+        entry.join('iptables.rules').write('cached\n')
+        assert list(fw.generate()[0]) == ['cached']
+
+        # Changing the config replaces the entry, and leaves other files alone
+        tmpdir.join('cache', 'unrelated').write('')
+        config['default']['filter']['INPUT'].append('-j DROP')
+        fw = fwgen.FwGen(config, cache=True)
+        assert '-A INPUT -j DROP' in list(fw.generate()[0])
+        assert entry not in tmpdir.join('cache').listdir()
+        assert len(tmpdir.join('cache').listdir()) == 2
+        assert tmpdir.join('cache', 'unrelated').check()
+
+        # The temporary directory is removed on any error
+        def rules():
+            yield 'rule'
+            raise ValueError
+        with pytest.raises(ValueError):
+            fw.cache.add('0' * 64, rules())
+        assert len(tmpdir.join('cache').listdir()) == 2
+
+    def test_yaml_load_ordered(self):
+        config = helpers.yaml_load_ordered('b: 1\na:\n  d: [1, 2]\n  c: 3\n')
+        assert isinstance(config, OrderedDict)
+        assert isinstance(config['a'], OrderedDict)
+        assert list(config.items()) == [('b', 1), ('a', OrderedDict([('d', [1, 2]),
+                                                                      ('c', 3)]))]
+
+    def test_yaml_load_file_cache(self, tmpdir):
+        config_file = tmpdir.join('config.yml')
+        cache_dir = tmpdir.join('cache')
+        config_file.write('a: 1\n')
+        assert helpers.yaml_load_file(str(config_file), str(cache_dir)) == {'a': 1}
+        assert len(cache_dir.listdir()) == 1
+
+        # The cached content is used as long as mtime and size are unchanged
+        mtime = os.stat(str(config_file)).st_mtime_ns
+        config_file.write('a: 2\n')
+        os.utime(str(config_file), ns=(mtime, mtime))
+        assert helpers.yaml_load_file(str(config_file), str(cache_dir)) == {'a': 1}
+
+        config_file.write('a: 10\n')
+        os.utime(str(config_file), ns=(mtime, mtime))
+        assert helpers.yaml_load_file(str(config_file), str(cache_dir)) == {'a': 10}
+        assert len(cache_dir.listdir()) == 1
+
+    def test_layered_dict(self):
+        def layers():
+            defaults = OrderedDict([
+                ('a', OrderedDict([('x', 1), ('y', OrderedDict([('z', 1)]))])),
+                ('b', OrderedDict([('x', 1)])),
+                ('c', [1, 2]),
+                ('d', {'x': 1})
+            ])
+            config = OrderedDict([
+                ('e', 1),
+                ('a', OrderedDict([('w', 2), ('y', OrderedDict([('z', 2), ('v', 2)]))])),
+                ('b', {'y': 2}),
+                ('d', OrderedDict([('y', 2)]))
+            ])
+            overlay = OrderedDict([
+                ('a', OrderedDict([('y', [3])])),
+                ('c', [3]),
+                ('b', OrderedDict([('z', 3)]))
+            ])
+            return defaults, config, overlay
+
+        defaults, config, overlay = layers()
+        expected = helpers.ordered_dict_merge(overlay, helpers.ordered_dict_merge(config,
+                                                                                  defaults))
+        layered = helpers.LayeredDict(*layers())
+        assert json.dumps(layered, default=helpers.json_default) == json.dumps(expected)
+        assert layered == expected
+        assert list(layered['a']) == ['x', 'y', 'w']
+        assert 'w' in layered['a'] and 'q' not in layered['a']
+        with pytest.raises(KeyError):
+            layered['q']
+
+        # Values that are not merged are taken from the layers as is
+        defaults, config, overlay = layers()
+        layered = helpers.LayeredDict(defaults, config, overlay)
+        assert layered['c'] is overlay['c']
+        assert layered['a']['x'] == 1
+        assert layered['a']['y'] is overlay['a']['y']
+
+    def test_ipset_entries_file(self, tmpdir):
+        entries_file = tmpdir.join('blocked.txt')
+        entries_file.write('# Blocklist\n10.0.0.1\n\n  10.0.0.2 timeout 300\n')
+        config = OrderedDefaultDict()
+        config['ipsets']['blocked']['type'] = 'hash:ip'
+        config['ipsets']['blocked']['entries'] = ['10.0.0.3']
+        config['ipsets']['blocked']['entries_file'] = str(entries_file)
+        config['ipsets']['empty']['type'] = 'hash:ip'
+        fw = fwgen.FwGen(config)
+        assert list(fw.generate()[2]) == [
+            'create blocked hash:ip',
+            'add blocked 10.0.0.3',
+            'add blocked 10.0.0.1',
+            'add blocked 10.0.0.2 timeout 300',
+            'create empty hash:ip'
+        ]
+
+        # The cache key follows changes to the entries file
+        key = fw._cache_key()
+        assert fw._cache_key() == key
+        entries_file.write('10.0.0.1\n', mode='a')
+        assert fw._cache_key() != key
+
+    def test_aggregate_networks(self):
+        networks = [
+            '10.0.0.0/25',
+            '10.0.0.128/25',
+            '10.0.1.0/24',
+            '10.0.0.5',
+            '10.1.0.1-10.1.0.6',
+            'fd00::/64',
+            'fd00:0:0:1::/64',
+            '192.168.1.1',
+            '192.168.1.3',
+            '10.2.0.1 nomatch',
+            '0.0.0.0/0'
+        ]
+        assert list(helpers.aggregate_networks(networks[:-1])) == [
+            '10.0.0.0/23',
+            '10.1.0.1',
+            '10.1.0.2/31',
+            '10.1.0.4/31',
+            '10.1.0.6',
+            '192.168.1.1',
+            '192.168.1.3',
+            'fd00::/63',
+            '10.2.0.1 nomatch'
+        ]
+        # ipset does not accept a zero prefix length
+        assert list(helpers.aggregate_networks(networks)) == [
+            '0.0.0.0/1',
+            '128.0.0.0/1',
+            'fd00::/63',
+            '10.2.0.1 nomatch'
+        ]
+
+    def test_ipset_aggregate(self, caplog):
+        config = OrderedDefaultDict()
+        config['ipsets']['nets']['type'] = 'hash:net'
+        config['ipsets']['nets']['aggregate'] = True
+        config['ipsets']['nets']['entries'] = ['10.0.0.0/24', '10.0.1.0/24', '10.0.0.1']
+        fw = fwgen.FwGen(config)
+        with caplog.at_level('INFO'):
+            assert list(fw.generate()[2]) == [
+                'create nets hash:net',
+                'add nets 10.0.0.0/23'
+            ]
+        assert "Aggregated ipset 'nets' from 3 to 1 entries" in caplog.text
+
+    def test_ipset_sizing(self, tmpdir, caplog):
+        entries_file = tmpdir.join('entries.txt')
+        entries_file.write(''.join('10.0.%d.%d\n' % (i >> 8, i & 255) for i in range(5000)))
+        config = OrderedDefaultDict()
+        config['ipsets']['small']['type'] = 'hash:ip'
+        config['ipsets']['small']['entries'] = ['10.0.0.1']
+        config['ipsets']['large']['type'] = 'hash:ip'
+        config['ipsets']['large']['entries_file'] = str(entries_file)
+        config['ipsets']['explicit']['type'] = 'hash:ip'
+        config['ipsets']['explicit']['options'] = 'maxelem 5100'
+        config['ipsets']['explicit']['entries_file'] = str(entries_file)
+        config['ipsets']['list']['type'] = 'list:set'
+        config['ipsets']['list']['entries'] = ['small']
+        fw = fwgen.FwGen(config)
+        with caplog.at_level('WARNING'):
+            creates = [i for i in fw.generate()[2] if i.startswith('create')]
+        assert creates == [
+            'create small hash:ip',
+            'create large hash:ip hashsize 8192',
+            'create explicit hash:ip maxelem 5100 hashsize 8192',
+            'create list list:set'
+        ]
+        assert "Ipset 'explicit' has 5000 entries" in caplog.text
+
+        config['ipsets']['undefined']['type'] = 'hash:ip'
+        config['ipsets']['undefined']['entries'] = ['${undefined}']
+        with pytest.raises(fwgen.RulesetError):
+            list(fwgen.FwGen(config)._output_ipsets())
+        del config['ipsets']['undefined']
+
+        # The entries are only generated once per set
+        read = []
+        read_entries_file = fw._read_entries_file
+        fw._read_entries_file = lambda *args: read.append(args[0]) or read_entries_file(*args)
+        list(fw._output_ipsets())
+        assert read == ['large', 'explicit']
+
+        config['ipsets']['large']['options'] = 'hashsize 1024'
+        entries_file.write(''.join('10.1.%d.%d\n' % (i >> 8, i & 255) for i in range(60000)),
+                           mode='a')
+        fw = fwgen.FwGen(config)
+        assert next(i for i in fw.generate()[2] if i.startswith('create large')) == \
+            'create large hash:ip hashsize 1024 maxelem 131072'
+
+    def test_promote_objects(self):
+        config = OrderedDefaultDict()
+        config['optimize']['object_ipsets'] = 3
+        config['objects']['hosts'] = ['10.0.0.1', '10.0.1.0/24', 'fd00::1']
+        config['objects']['few'] = ['10.0.0.1', '10.0.0.2']
+        config['objects']['ports'] = ['22', '80', '443']
+        config['objects']['a_very_long_object_name'] = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+        config['default']['filter']['INPUT'] = [
+            '-s ${hosts} -j ACCEPT',
+            '-p tcp --dport 22 --destination ${hosts} -j ACCEPT',
+            '! -s ${hosts} -j DROP',
+            '-s ${few} -j ACCEPT',
+            '-p tcp --dport ${ports} -j ACCEPT',
+            '-d ${a_very_long_object_name} -j ACCEPT'
+        ]
+        fw = fwgen.FwGen(config)
+        ip_rules, ip6_rules, ipsets = fw.generate()
+        long_name = fw._get_object_ipset_name('a_very_long_object_name', 4)
+        assert long_name.startswith('fwgen-') and len(long_name) <= 27
+
+        rules = [i for i in ip_rules if i.startswith('-A INPUT')]
+        assert rules == [
+            '-A INPUT -m set --match-set fwgen-hosts-4 src -j ACCEPT',
+            '-A INPUT -p tcp --dport 22 -m set --match-set fwgen-hosts-4 dst -j ACCEPT',
+            '-A INPUT ! -s 10.0.0.1 -j DROP',
+            '-A INPUT ! -s 10.0.1.0/24 -j DROP',
+            '-A INPUT -s 10.0.0.1 -j ACCEPT',
+            '-A INPUT -s 10.0.0.2 -j ACCEPT',
+            '-A INPUT -p tcp --dport 22 -j ACCEPT',
+            '-A INPUT -p tcp --dport 80 -j ACCEPT',
+            '-A INPUT -p tcp --dport 443 -j ACCEPT',
+            '-A INPUT -m set --match-set %s dst -j ACCEPT' % long_name
+        ]
+        assert '-A INPUT -m set --match-set fwgen-hosts-6 src -j ACCEPT' in list(ip6_rules)
+        assert list(ipsets) == [
+            'create fwgen-hosts-4 hash:net family inet',
+            'add fwgen-hosts-4 10.0.0.1',
+            'add fwgen-hosts-4 10.0.1.0/24',
+            'create fwgen-hosts-6 hash:net family inet6',
+            'add fwgen-hosts-6 fd00::1',
+            'create %s hash:net family inet' % long_name,
+            'add %s 10.0.0.1' % long_name,
+            'add %s 10.0.0.2' % long_name,
+            'add %s 10.0.0.3' % long_name
+        ]
+
+    def test_optimize_rules(self, caplog):
+        config = OrderedDefaultDict()
+        config['optimize']['remove_duplicates'] = True
+        config['optimize']['shadowed_rules'] = 'remove'
+        config['objects']['hosts'] = ['10.0.0.1', '10.0.0.1', 'fd00::1']
+        config['default']['filter']['INPUT'] = [
+            '-s ${hosts} -j ACCEPT',
+            '-4 -s 10.0.0.1 -j ACCEPT',
+            '-m limit --limit 1/s -j ACCEPT',
+            '-m limit --limit 1/s -j ACCEPT',
+            '-p tcp -j LOG',
+            '-p tcp -j LOG',
+            '-4 -m comment --comment "Drop IPv4" -j DROP',
+            '-4 -p udp -j ACCEPT',
+            '-p tcp -j ACCEPT',
+            '-6 -p tcp -j ACCEPT'
+        ]
+        config['default']['mangle']['PREROUTING'] = [
+            '-m mark --mark 1 -j ACCEPT',
+            '-j MARK --set-mark 1',
+            '-m mark --mark 1 -j ACCEPT'
+        ]
+        fw = fwgen.FwGen(config)
+        with caplog.at_level('INFO'):
+            rules = [i for i in fw._output_rules(fw._get_all_rules())
+                     if i.startswith(('-4 -A', '-6 -A', '-A'))]
+        assert rules == [
+            '-4 -A INPUT -s 10.0.0.1 -j ACCEPT',
+            '-6 -A INPUT -s fd00::1 -j ACCEPT',
+            '-A INPUT -m limit --limit 1/s -j ACCEPT',
+            '-A INPUT -m limit --limit 1/s -j ACCEPT',
+            '-A INPUT -p tcp -j LOG',
+            '-A INPUT -p tcp -j LOG',
+            '-A INPUT -4 -m comment --comment "Drop IPv4" -j DROP',
+            '-A INPUT -p tcp -j ACCEPT',
+            '-A PREROUTING -m mark --mark 1 -j ACCEPT',
+            '-A PREROUTING -j MARK --set-mark 1',
+            '-A PREROUTING -m mark --mark 1 -j ACCEPT'
+        ]
+        assert 'Removed 3 duplicate and 1 shadowed rules from filter/INPUT' in caplog.text
+        assert 'mangle/PREROUTING' not in caplog.text
+
+        # The report is only logged once
+        caplog.clear()
+        list(fw._output_rules(fw._get_all_rules()))
+        assert 'Removed' not in caplog.text
+
+    def test_optimize_rules_options(self):
+        config = OrderedDefaultDict()
+        config['optimize']['remove_duplicates'] = True
+        config['optimize']['shadowed_rules'] = 'remove'
+        config['default']['filter']['INPUT'] = [
+            '--match limit --limit 1/s --jump ACCEPT',
+            '--match limit --limit 1/s --jump ACCEPT',
+            '-p tcp -m limit -j ACCEPT',
+            '-p tcp -m limit -j ACCEPT',
+            '-g custom',
+            '-j ACCEPT',
+            '-p tcp --jump DROP'
+        ]
+        fw = fwgen.FwGen(config)
+        rules = [i for i in fw._output_rules(fw._get_all_rules()) if i.startswith('-A')]
+        assert rules == [
+            '-A INPUT --match limit --limit 1/s --jump ACCEPT',
+            '-A INPUT --match limit --limit 1/s --jump ACCEPT',
+            '-A INPUT -p tcp -m limit -j ACCEPT',
+            '-A INPUT -p tcp -m limit -j ACCEPT',
+            '-A INPUT -g custom',
+            '-A INPUT -j ACCEPT'
+        ]
+
+        assert fw._split_target('-m comment --comment "a -j DROP" --goto custom') == (
+            '-m comment --comment "a -j DROP" ', 'custom')
+        assert fw._is_reorderable('-A INPUT -p tcp --jump ACCEPT') == '-j ACCEPT'
+        assert fw._is_reorderable('-A INPUT -p tcp -j REJECT --reject-with tcp-reset') == (
+            '-j REJECT --reject-with tcp-reset')
+        assert fw._is_reorderable('-A INPUT -p tcp -m limit -j ACCEPT') is None
+        assert fw._is_reorderable('-A INPUT -p tcp --match recent --jump DROP') is None
+        assert fw._is_reorderable('-A INPUT -p tcp -g ACCEPT_RULES') is None
+
+    def test_analyze(self):
+        config = OrderedDefaultDict()
+        config['default']['filter']['INPUT'] = [
+            '-p tcp --dport 22 -j ACCEPT',
+            '-p tcp --dport 80 -j ACCEPT',
+            '-p tcp --dport 443 -j ACCEPT',
+            '-j LOG',
+            '-p udp -j ACCEPT'
+        ]
+        fw = fwgen.FwGen(config)
+        counters = OrderedDict([
+            (('filter', 'INPUT'), {'policy': 10, 'rules': [1, 50, 100, 0, 5]})
+        ])
+        fw.iptables.counters = lambda: counters
+        fw.ip6tables.counters = lambda: OrderedDict([
+            (('filter', 'INPUT'), {'policy': 0, 'rules': [0, 0, 0, 0, 0]})
+        ])
+        report = fw.analyze(interval=0)
+        assert report['ip6tables'] == []
+        assert report['iptables'] == [{
+            'table': 'filter',
+            'chain': 'INPUT',
+            'packets': 166,
+            'before': 476,
+            'after': 278,
+            'order': [
+                ('-A INPUT -p tcp --dport 443 -j ACCEPT', 100),
+                ('-A INPUT -p tcp --dport 80 -j ACCEPT', 50),
+                ('-A INPUT -p tcp --dport 22 -j ACCEPT', 1),
+                ('-A INPUT -j LOG', 0),
+                ('-A INPUT -p udp -j ACCEPT', 5)
+            ]
+        }]
+
+        counters[('filter', 'INPUT')]['rules'].pop()
+        with pytest.raises(fwgen.RulesetError):
+            fw.analyze(interval=0)
+
+    def test_analyze_target_options(self):
+        config = OrderedDefaultDict()
+        config['default']['filter']['INPUT'] = [
+            '-p tcp --dport 22 -j REJECT --reject-with tcp-reset',
+            '-p tcp -j REJECT --reject-with icmp-port-unreachable',
+            '-p udp -j REJECT --reject-with icmp-port-unreachable'
+        ]
+        fw = fwgen.FwGen(config)
+        fw.iptables.counters = lambda: OrderedDict([
+            (('filter', 'INPUT'), {'policy': 0, 'rules': [1, 50, 100]})
+        ])
+        fw.ip6tables.counters = lambda: OrderedDict([
+            (('filter', 'INPUT'), {'policy': 0, 'rules': [0, 0, 0]})
+        ])
+        report = fw.analyze(interval=0)
+
+        # Rules rejecting with different responses are never swapped
+        assert report['iptables'][0]['order'] == [
+            ('-A INPUT -p tcp --dport 22 -j REJECT --reject-with tcp-reset', 1),
+            ('-A INPUT -p udp -j REJECT --reject-with icmp-port-unreachable', 100),
+            ('-A INPUT -p tcp -j REJECT --reject-with icmp-port-unreachable', 50)
+        ]
+
+    def test_get_rule_sources_unknown_rule(self):
+        config = OrderedDefaultDict()
+        config['default']['filter']['INPUT'] = [
+            '-p tcp -j ACCEPT',
+            '-p udp -j ACCEPT'
+        ]
+        fw = fwgen.FwGen(config)
+        output_rules = fw._output_rules
+
+        # Rules rewritten after compilation have no config rule to map to
+        def rewritten(rules):
+            for rule in output_rules(rules):
+                yield rule.replace('-p tcp', '-p sctp')
+        fw._output_rules = rewritten
+
+        assert fw._get_rule_sources(4)[('filter', 'INPUT')] == [
+            ('-A INPUT -p sctp -j ACCEPT', '-A INPUT -p sctp -j ACCEPT'),
+            ('-A INPUT -p udp -j ACCEPT', '-A INPUT -p udp -j ACCEPT')
+        ]
+
+    def test_iptables_counters(self, tmpdir):
+        save = tmpdir.join('iptables-save')
+        save.write('#!/bin/sh\n'
+                   '[ "$1" = "-c" ] || exit 1\n'
+                   'echo "*filter"\n'
+                   'echo ":INPUT DROP [10:800]"\n'
+                   'echo ":zone0 - [0:0]"\n'
+                   'echo "[5:400] -A INPUT -j zone0"\n'
+                   'echo "[2:100] -A zone0 -p tcp -j ACCEPT"\n'
+                   'echo "COMMIT"\n')
+        save.chmod(0o700)
+        iptables = fwgen.Iptables(iptables_save=str(save))
+        assert iptables.counters() == OrderedDict([
+            (('filter', 'INPUT'), {'policy': 10, 'rules': [5]}),
+            (('filter', 'zone0'), {'policy': None, 'rules': [2]})
+        ])
+
+    def test_archive_file(self, tmpdir, monkeypatch):
+        import tarfile
+
+        with tarfile.open(str(tmpdir.join('archive.tar.xz')), 'w:xz') as tar:
+            for name in ['iptables', 'ip6tables', 'ipsets']:
+                tmpdir.join(name).write('%s rule 1\n%s rule 2\n' % (name, name))
+                tar.add(str(tmpdir.join(name)), arcname='%s.restore' % name)
+
+        opened = []
+        tarfile_open = tarfile.open
+        monkeypatch.setattr(tarfile, 'open', lambda *args, **kwargs: opened.append(args)
+                            or tarfile_open(*args, **kwargs))
+
+        archive_file = fwgen.ArchiveFile(Path(str(tmpdir.join('archive.tar.xz'))))
+        assert archive_file.iptables() == ['iptables rule 1', 'iptables rule 2']
+        assert archive_file.ip6tables() == ['ip6tables rule 1', 'ip6tables rule 2']
+        assert archive_file.ipsets() == ['ipsets rule 1', 'ipsets rule 2']
+        assert len(opened) == 1
+
+    @staticmethod
+    def _restore_files(tmpdir, rule):
+        files = []
+        for name in ['iptables', 'ip6tables', 'ipsets']:
+            tmpdir.join(name).write('%s %s\n' % (name, rule))
+            files.append(Path(str(tmpdir.join(name))))
+        return files
+
+    def test_archive_compression(self, tmpdir):
+        import tarfile
+
+        path = Path(str(tmpdir.join('archive')))
+        for i, (compression, level) in enumerate([('xz', 0), ('gz', 1), ('bz2', None),
+                                                  ('none', None)]):
+            archive = fwgen.Archive(path, compression, level)
+            archive.create()
+            snapshot = archive.add(*self._restore_files(tmpdir, compression))
+            snapshot.path.rename(path / ('%d.json' % i))
+
+        # Legacy tarball archives are still available
+        with tarfile.open(str(path / '4.tar.gz'), 'w:gz') as tar:
+            for name in ['iptables', 'ip6tables', 'ipsets']:
+                tar.add(str(tmpdir.join(name)), arcname='%s.restore' % name)
+
+        assert [i.name for _, i in archive.get_all_indexed()] == [
+            '4.tar.gz', '3.json', '2.json', '1.json', '0.json']
+        assert [archive.get(str(i)).iptables() for i in range(5)] == [
+            ['iptables none'], ['iptables none'], ['iptables bz2'], ['iptables gz'],
+            ['iptables xz']]
+        with (archive.blobs / archive.get('0.json').digests()['ipsets.restore']).open('rb') as f:
+            assert f.read(6) == b'\xfd7zXZ\x00'
+
+        with pytest.raises(ValueError):
+            fwgen.Archive(path, 'zip')
+        for compression, level in [('xz', 10), ('gz', -1), ('bz2', 0), ('xz', '6'),
+                                   ('gz', True)]:
+            with pytest.raises(ValueError):
+                fwgen.Archive(path, compression, level)
+        assert fwgen.Archive(path, 'none', 6).level is None
+
+    def test_archive_dedup(self, tmpdir):
+        path = Path(str(tmpdir.join('archive')))
+        archive = fwgen.Archive(path)
+        archive.create()
+
+        first = archive.add(*self._restore_files(tmpdir, 'rule 1'))
+        first.path.rename(path / '0.json')
+        assert archive.add(*self._restore_files(tmpdir, 'rule 1')).name == '0.json'
+        assert len(list(archive.get_all())) == 1
+        assert len(list(archive.blobs.iterdir())) == 3
+
+        # Only the changed file is stored again
+        files = self._restore_files(tmpdir, 'rule 1')
+        tmpdir.join('ipsets').write('ipsets rule 2\n')
+        previous = archive.add(*files)
+        assert len(list(archive.get_all())) == 2
+        assert len(list(archive.blobs.iterdir())) == 4
+
+        # Archives added within the same second are all kept
+        tmpdir.join('ipsets').write('ipsets rule 3\n')
+        latest = archive.add(*files)
+        assert latest.name != previous.name
+        assert len(list(archive.get_all())) == 3
+        assert previous.ipsets() == ['ipsets rule 2']
+
+        archive.gc(1)
+        assert [i.name for i in archive.get_all()] == [latest.name]
+        assert len(list(archive.blobs.iterdir())) == 3
+        assert latest.ipsets() == ['ipsets rule 3']
+
+        archive.gc(0)
+        assert not list(archive.get_all())
+        assert not list(archive.blobs.iterdir())
+
+    def test_archive_delta(self, tmpdir):
+        path = Path(str(tmpdir.join('archive')))
+        archive = fwgen.Archive(path, snapshot_interval=3)
+        archive.create()
+
+        versions = []
+        for i in range(5):
+            files = self._restore_files(tmpdir, 'rule')
+            rules = ['ipsets rule %d\n' % j for j in range(20)]
+            rules[i] = 'ipsets changed %d\n' % i
+            tmpdir.join('ipsets').write(''.join(rules))
+            archive.add(*files).path.rename(path / ('%d.json' % i))
+            versions.append([j.rstrip('\n') for j in rules])
+
+        digests = [archive.get('%d.json' % i).digests()['ipsets.restore'] for i in range(5)]
+        assert [(archive.blobs / i).exists() for i in digests] == [
+            True, False, False, True, False]
+        for i in range(5):
+            assert archive.get('%d.json' % i).ipsets() == versions[i]
+
+        # Bases of the kept deltas are kept
+        archive.gc(3)
+        assert [i.name for _, i in archive.get_all_indexed()] == ['4.json', '3.json', '2.json']
+        assert archive.get('2.json').ipsets() == versions[2]
+        assert sorted(i.name for i in archive.blobs.iterdir()) == sorted(
+            [digests[0], digests[1] + '.delta', digests[2] + '.delta', digests[3],
+             digests[4] + '.delta'] + list(archive.get('4.json').digests().values())[:2])
+
+        archive.gc(2)
+        assert len(list(archive.blobs.iterdir())) == 4
+        assert archive.get('4.json').ipsets() == versions[4]
+
+    def test_archive_delta_edits(self, tmpdir):
+        path = Path(str(tmpdir.join('archive')))
+        archive = fwgen.Archive(path, snapshot_interval=10)
+        archive.create()
+
+        rules = ['*filter'] + ['-A INPUT -s 10.0.0.%d -j ACCEPT' % i for i in range(200)]
+        rules += ['COMMIT', '*nat', 'COMMIT']
+        versions = [
+            rules,
+            rules[:50] + ['-A INPUT -j DROP'] + rules[50:],
+            rules[:10] + rules[100:150] + rules[10:100] + rules[150:],
+            rules[:-1] + ['-A POSTROUTING -j MASQUERADE', 'COMMIT'],
+            rules[5:] + rules[:5],
+            [],
+        ]
+        names = []
+        for i, version in enumerate(versions):
+            files = self._restore_files(tmpdir, 'rule')
+            tmpdir.join('ipsets').write(''.join('%s\n' % j for j in version))
+            snapshot = archive.add(*files)
+            snapshot.path.rename(path / ('%d.json' % i))
+            names.append('%d.json' % i)
+
+        for name, version in zip(names, versions):
+            assert archive.get(name).ipsets() == version
+
+        # A single added line gives a small delta
+        digest = archive.get('1.json').digests()['ipsets.restore']
+        assert archive._read_delta(digest)['ops'] == [[0, 50], '-A INPUT -j DROP\n',
+                                                      [50, 204]]
+
+    def test_archive_index(self, tmpdir, monkeypatch):
+        path = Path(str(tmpdir.join('archive')))
+        archive = fwgen.Archive(path)
+        archive.create()
+        for i in range(3):
+            archive.add(*self._restore_files(tmpdir, 'rule %d' % i)).path.rename(
+                path / ('%d.json' % i))
+        assert [i.name for _, i in archive.get_all_indexed()] == ['2.json', '1.json', '0.json']
+
+        # Listing and lookups are served from the index file without scanning
+        archive = fwgen.Archive(path)
+        monkeypatch.setattr(fwgen.Archive, '_scan', None)
+        assert [i.name for _, i in archive.get_all_indexed()] == ['2.json', '1.json', '0.json']
+        assert archive.get('1').name == '1.json'
+        assert archive.get('0.json').iptables() == ['iptables rule 0']
+        monkeypatch.undo()
+
+        digests = archive.get('2.json').digests()
+        with path.joinpath('index').open('r') as f:
+            assert f.readline() == '2.json\t%d\t%s,%s,%s\t16,17,14\n' % (
+                path.joinpath('2.json').stat().st_mtime, digests['iptables.restore'],
+                digests['ip6tables.restore'], digests['ipsets.restore'])
+
+        # Changes done outside of fwgen make the index stale
+        path.joinpath('1.json').unlink()
+        assert [i.name for _, i in archive.get_all_indexed()] == ['2.json', '0.json']
+        with pytest.raises(fwgen.NonExistingArchiveError):
+            archive.get('1.json')
+
+        # gc does not trust the index, even if a change went unnoticed
+        assert archive.get('0.json')
+        with path.joinpath('0.json').open('r') as f:
+            manifest = f.read()
+        with path.joinpath('3.json').open('w') as f:
+            f.write(manifest)
+        mtime = path.stat().st_mtime_ns
+        os.utime(str(path.joinpath('index')), ns=(mtime, mtime))
+        archive.gc(1)
+        assert archive.get('3.json').ipsets() == ['ipsets rule 0']